@@ -1,44 +1,473 @@
+import base64
+import csv
+import datetime
+import hashlib
+import io
+import json
 import sys
 import os
+import time
 from flask import (
     Flask,
     request,
     abort,
-    jsonify
+    jsonify,
+    Response,
+    make_response,
+    stream_with_context
     )
+from sqlalchemy.exc import SQLAlchemyError
 from flask_sqlalchemy import SQLAlchemy
 from flask_cors import CORS
+from sqlalchemy import func, text
+from sqlalchemy.orm import load_only
 from models import (
+    db,
     setup_db,
     db_drop_and_create_all,
     Animal,
-    Species
+    Species,
+    animal_counter,
+    animal_version,
+    species_cache,
+    species_stats,
+    slow_query_log,
+    pool_status
     )
 import random
+from functools import wraps
 from auth import AuthError, requires_auth
+from coalescing import coalesce
+from compression import etag_variants, init_compression
+from encoders import init_encoder, json_response
+from idempotency import idempotent, init_idempotency
+from metrics import init_metrics
+from ratelimit import init_rate_limits
 
 # create option for paginating animals response
 
 ANIMALS_PER_PAGE = 10
+# upper bound for ?per_page= so one request can't load the whole table
+MAX_ANIMALS_PER_PAGE = int(os.environ.get('MAX_ANIMALS_PER_PAGE', 100))
+# range of the integer columns
+MIN_INTEGER, MAX_INTEGER = -2 ** 31, 2 ** 31 - 1
+# largest OFFSET the databases accept
+MAX_OFFSET = 2 ** 63 - 1
+
+
+# columns GET /animals can be sorted by, ?sort=-age sorts descending
+SORT_COLUMNS = {
+    'id': Animal.id,
+    'name': Animal.name,
+    'age': Animal.age
+}
+
+
+def encode_cursor(animal, sort='id'):
+    # opaque cursor for the keyset pagination, the id alone when sorted by
+    # id, else the sort value and the id as tie breaker
+    if sort == 'id':
+        value = str(animal.id)
+    else:
+        value = json.dumps([getattr(animal, sort), animal.id])
+    return base64.urlsafe_b64encode(value.encode()).decode()
+
+
+def decode_cursor(cursor, sort='id'):
+    try:
+        value = json.loads(base64.urlsafe_b64decode(cursor.encode()).decode())
+        if sort == 'id':
+            sort_value, last_id = None, value
+        else:
+            sort_value, last_id = value
+        python_type = SORT_COLUMNS[sort].type.python_type
+    except Exception:
+        abort(400)
+    if sort == 'id':
+        valid_value = True
+    elif python_type is int:
+        valid_value = is_integer(sort_value)
+    else:
+        valid_value = isinstance(sort_value, python_type)
+    if not valid_value or not is_integer(last_id):
+        abort(400)
+    return sort_value, last_id
+
+
+def sort_arg(request):
+    # the sort column of GET /animals and if the order is descending
+    sort = request.args.get('sort', 'id')
+    descending = sort.startswith('-')
+    sort = sort.lstrip('-')
+    if sort not in SORT_COLUMNS:
+        abort(400)
+    return sort, descending
+
+
+def fields_arg(request, allowed):
+    # the fields of ?fields=id,name or None, 400 for unknown fields
+    value = request.args.get('fields')
+    if value is None:
+        return None
+    fields = [field.strip() for field in value.split(',') if field.strip()]
+    if not fields or any(field not in allowed for field in fields):
+        abort(400)
+    return fields
+
+
+def is_integer(value):
+    # True for an int that fits into an integer column, bools don't count
+    return type(value) is int and MIN_INTEGER <= value <= MAX_INTEGER
+
+
+def int_arg(request, name):
+    # optional integer query parameter, 400 if it is not a number or
+    # doesn't fit into an integer column
+    value = request.args.get(name)
+    if value is None:
+        return None
+    try:
+        value = int(value)
+    except ValueError:
+        abort(400)
+    if not MIN_INTEGER <= value <= MAX_INTEGER:
+        abort(400)
+    return value
+
+
+# query parameters of GET /animals that filter the animals
+ANIMAL_FILTERS = ('species_id', 'min_age', 'max_age', 'q')
+
+
+def has_filters(request):
+    # True if filter_animals adds a WHERE clause, empty values are skipped
+    return any(request.args.get(name) for name in ANIMAL_FILTERS)
+
+
+def filter_animals(request, selection):
+    # turns the filters and the search of GET /animals into WHERE clauses
+
+    species_id = int_arg(request, 'species_id')
+    if species_id is not None:
+        selection = selection.filter(Animal.species_id == species_id)
+
+    min_age = int_arg(request, 'min_age')
+    if min_age is not None:
+        selection = selection.filter(Animal.age >= min_age)
+
+    max_age = int_arg(request, 'max_age')
+    if max_age is not None:
+        selection = selection.filter(Animal.age <= max_age)
+
+    # substring search, uses the trigram indexes on PostgreSQL
+    search = request.args.get('q')
+    if search:
+        pattern = '%' + search.replace('\\', '\\\\').replace(
+            '%', '\\%').replace('_', '\\_') + '%'
+        selection = selection.filter(
+            Animal.name.ilike(pattern, escape='\\') |
+            Animal.comment.ilike(pattern, escape='\\'))
+
+    return selection
 
 
 def paginate_animals(request, selection):
+    # selection is an Animal query, only the requested page is loaded
+    # with LIMIT/OFFSET or, if ?after= is given, with a keyset on the
+    # sort column and the id
+
+    per_page = request.args.get('per_page', ANIMALS_PER_PAGE, type=int)
+    per_page = min(per_page, MAX_ANIMALS_PER_PAGE)
+    if per_page < 1:
+        abort(400)
+
+    sort, descending = sort_arg(request)
+    column = SORT_COLUMNS[sort]
+
+    if descending:
+        order = [column.desc(), Animal.id.desc()]
+    else:
+        order = [column, Animal.id]
+    if sort == 'id':
+        order = order[:1]
+
+    cursor = request.args.get('after')
+    if cursor is not None:
+        sort_value, last_id = decode_cursor(cursor, sort)
+        if sort == 'id':
+            after = Animal.id < last_id if descending else Animal.id > last_id
+        elif descending:
+            after = (column < sort_value) | \
+                ((column == sort_value) & (Animal.id < last_id))
+        else:
+            after = (column > sort_value) | \
+                ((column == sort_value) & (Animal.id > last_id))
+        selection = selection.filter(after).order_by(*order)
+    else:
+        page = request.args.get('page', 1, type=int)
+        if page < 1 or (page - 1) * per_page > MAX_OFFSET:
+            abort(400)
+        selection = selection.order_by(*order)
+        selection = selection.offset((page - 1) * per_page)
+
+    # fetch one row more to know if there is a next page
+    animals = selection.limit(per_page + 1).all()
+    next_cursor = None
+    if len(animals) > per_page:
+        animals = animals[:per_page]
+        next_cursor = encode_cursor(animals[-1], sort)
+
+    return animals, next_cursor
+
+
+def conditional_get(table_version):
+    # answers If-None-Match with 304 before the handler runs, the ETag is
+    # derived from the version of the table and the requested url
+    def conditional_get_decorator(f):
+        @wraps(f)
+        def wrapper(*args, **kwargs):
+            etag = hashlib.sha1('{}|{}'.format(
+                table_version(), request.full_path).encode()).hexdigest()
+
+            # the compressed variants of the response have their own ETag
+            for variant in etag_variants(etag):
+                if request.if_none_match.contains(variant):
+                    response = Response(status=304)
+                    response.set_etag(variant)
+                    return response
+
+            response = make_response(f(*args, **kwargs))
+            response.set_etag(etag)
+            return response
+        return wrapper
+    return conditional_get_decorator
+
+
+def animal_read_version():
+    # the version of the animals for conditional_get, with the version of
+    # the species mixed in when the response shows them, so renaming a
+    # species changes the ETag: GET /animals with details, GET
+    # /animals/<id> without fields and both with the species field
+    version = animal_version.get()
+    fields = request.args.get('fields')
+    if fields is not None:
+        shows_species = 'species' in [field.strip()
+                                      for field in fields.split(',')]
+    elif 'animal_id' in request.view_args:
+        shows_species = True
+    else:
+        shows_species = request.args.get(
+            'details', 'false').lower() == 'true'
+    if shows_species:
+        version += '|' + species_cache.get_version()
+    return version
+
+
+# fields every new animal needs
+ANIMAL_FIELDS = ('name', 'age', 'comment', 'species_id')
+# the text fields and their maximum length, the length of the column
+ANIMAL_TEXT_FIELDS = {field: getattr(Animal, field).type.length
+                      for field in ('name', 'comment')}
+# number of rows per INSERT statement of the bulk import
+BULK_CHUNK_SIZE = int(os.environ.get('BULK_CHUNK_SIZE', 500))
+
+
+def species_stats_entry(specie, stats):
+    # the statistics of a species, zero for a species without animals
+    entry = {'id': specie['id'], 'name': specie['name']}
+    entry.update(stats or species_stats.empty())
+    return entry
+
+
+def validate_animal(body):
+    # returns the list of problems of a new animal, empty if it is valid
+    if not isinstance(body, dict):
+        return ['animal must be a JSON object']
+
+    errors = [field + ' is missing' for field in ANIMAL_FIELDS
+              if body.get(field) is None]
+    for field in ('age', 'species_id'):
+        if body.get(field) is not None:
+            try:
+                value = int(body.get(field))
+            except (TypeError, ValueError):
+                errors.append(field + ' must be an integer')
+                continue
+            if not MIN_INTEGER <= value <= MAX_INTEGER:
+                errors.append(field + ' is out of range')
+    for field, length in ANIMAL_TEXT_FIELDS.items():
+        value = body.get(field)
+        if value is None:
+            continue
+        if not isinstance(value, str):
+            errors.append(field + ' must be a string')
+        elif len(value) > length:
+            errors.append('{} is longer than {} characters'.format(
+                field, length))
+    return errors
+
+
+def read_bulk_rows():
+    # yields (row number, parsed row or None, errors) from a JSON array
+    # or, without buffering the whole body, from an NDJSON stream
+    if request.mimetype in ('application/x-ndjson', 'application/jsonl'):
+        for number, line in enumerate(request.stream):
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                yield number, json.loads(line), []
+            except ValueError:
+                yield number, None, ['invalid JSON']
+        return
+
+    body = request.get_json(silent=True)
+    if not isinstance(body, list):
+        abort(400)
+    for number, row in enumerate(body):
+        yield number, row, []
+
+
+def import_animal_chunk(chunk):
+    # inserts the valid rows of a chunk, returns the number of inserted
+    # rows and the errors of the rejected rows
+
+    errors = []
+
+    names = [row['name'] for number, row in chunk]
+    taken = {name for name, in Animal.query.with_entities(
+        Animal.name).filter(Animal.name.in_(names))}
+
+    rows = []
+    numbers = []
+    for number, row in chunk:
+        if species_cache.get(row['species_id']) is None:
+            errors.append({'row': number, 'errors': ['unknown species_id']})
+        elif row['name'] in taken:
+            errors.append({'row': number, 'errors': ['name already exists']})
+        else:
+            taken.add(row['name'])
+            rows.append({'name': row['name'],
+                         'age': int(row['age']),
+                         'comment': row['comment'],
+                         'species_id': int(row['species_id'])})
+            numbers.append(number)
+
+    try:
+        Animal.insert_many(rows)
+        return len(rows), errors
+    except SQLAlchemyError:
+        # a concurrent write got in between or the database refused a
+        # row, insert the rows one by one to find the ones that fail
+        db.session.rollback()
+
+    inserted = 0
+    for number, row in zip(numbers, rows):
+        try:
+            Animal.insert_many([row])
+            inserted += 1
+        except SQLAlchemyError as e:
+            db.session.rollback()
+            errors.append({'row': number,
+                           'errors': [str(getattr(e, 'orig', e))]})
+    return inserted, errors
+
+
+# maximum number of ids of a batch PATCH or DELETE
+MAX_BATCH_IDS = int(os.environ.get('MAX_BATCH_IDS', 1000))
+
+
+def batch_selection(request, body):
+    # the animals of a batch PATCH or DELETE: the ids of the body and the
+    # filters of GET /animals in the query string, one of them is needed
+    # so a request without them doesn't change every animal
+    selection = filter_animals(request, Animal.query)
+    ids = body.get('ids')
+    if ids is not None:
+        if not isinstance(ids, list) or len(ids) > MAX_BATCH_IDS or \
+                not all(is_integer(animal_id) for animal_id in ids):
+            abort(422)
+        selection = selection.filter(Animal.id.in_(ids))
+    elif not has_filters(request):
+        abort(422)
+    return selection
+
+
+# rows fetched per round trip from the server-side cursor of the export
+EXPORT_BATCH_SIZE = int(os.environ.get('EXPORT_BATCH_SIZE', 1000))
+
+EXPORT_FORMATS = {
+    'ndjson': 'application/x-ndjson',
+    'csv': 'text/csv'
+}
+
+
+def export_animals(export_format, batch_size=EXPORT_BATCH_SIZE):
+    # yields the animals table in chunks of text, only one batch of rows
+    # is held in memory at any time
+    columns = ('id', 'name', 'age', 'comment', 'species_id')
+    rows = db.session.query(
+        Animal.id, Animal.name, Animal.age, Animal.comment,
+        Animal.species_id).order_by(Animal.id).yield_per(batch_size)
+
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    if export_format == 'csv':
+        writer.writerow(columns)
+
+    for number, row in enumerate(rows, 1):
+        if export_format == 'csv':
+            writer.writerow(row)
+        else:
+            buffer.write(json.dumps(dict(zip(columns, row))) + '\n')
+
+        if number % batch_size == 0:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
 
-    page = request.args.get('page', 1, type=int)
-    start = (page - 1) * ANIMALS_PER_PAGE
-    end = start + ANIMALS_PER_PAGE
+    if buffer.tell():
+        yield buffer.getvalue()
 
-    animals = [animal.format() for animal in selection]
-    active_animals = animals[start:end]
 
-    return active_animals
+# 'daily' keeps the same animal of the day for a whole day,
+# 'random' picks a new one on every request
+ANIMAL_OF_THE_DAY_MODE = os.environ.get('ANIMAL_OF_THE_DAY_MODE', 'daily')
+
+# the animal of the day of this process, computed once per day
+animal_of_the_day = {'day': None, 'animal_id': None, 'response': None}
+
+
+def pick_random_animal(fraction):
+    # one query: seek to the first animal after the given fraction of the
+    # range of ids, which also works when ids have gaps
+    low = db.session.query(func.min(Animal.id)).as_scalar()
+    high = db.session.query(func.max(Animal.id)).as_scalar()
+
+    return Animal.query.filter(
+        Animal.id > low - 1 + (high - low + 1) * fraction).order_by(
+        Animal.id).first()
 
 
 def create_app(test_config=None):
     # create and configure the app
     app = Flask(__name__)
+    if test_config is not None:
+        app.config.update(test_config)
+    init_encoder(app)
     CORS(app)
     setup_db(app)
+    init_metrics(app)
+    init_compression(app)
+    init_idempotency(app)
+    # requests per second and burst per token of the expensive routes,
+    # the others get RATE_LIMIT and RATE_LIMIT_BURST
+    init_rate_limits(app, {
+        'export_animals_table': (0.1, 2),
+        'post_animals_bulk': (0.5, 5),
+        'patch_animals_batch': (1, 5),
+        'delete_animals_batch': (1, 5)
+    })
     # cors = CORS(app, resources={r"/api/*": {"origins": "*"}})
 
     '''
@@ -61,107 +490,199 @@ def create_app(test_config=None):
 
     @app.route('/')
     def start():
-        animals = Animal.query.order_by(Animal.id).all()
+        today = datetime.date.today()
+        if ANIMAL_OF_THE_DAY_MODE == 'daily':
+            if animal_of_the_day['day'] == today:
+                return jsonify(animal_of_the_day['response'])
+            # the same seed gives every worker the same animal of the day
+            fraction = random.Random(today.toordinal()).random()
+        else:
+            fraction = random.random()
+
+        random_animal = pick_random_animal(fraction)
 
-        if animals is None:
+        if random_animal is None:
             return jsonify({'message': 'Hello there, currently' +
                             'there is no animal here!'
                             })
 
-        else:
-            random_animal_number = random.randrange(1, len(animals) + 1)
-            random_animal = Animal.query.filter(
-                Animal.id == random_animal_number).one_or_none()
-            random_species = Species.query.filter(
-                Species.id == random_animal.species_id).one_or_none()
-
-            return jsonify({'A message': 'Hello there,' +
-                            'the animal of the day is:',
-                            'Animal': random_animal.name,
-                            'Comment': random_animal.comment,
-                            'Species': random_species.name,
-                            "Species Comment": random_species.description
-                            })
+        random_species = species_cache.get(random_animal.species_id)
+        response = {'A message': 'Hello there,' +
+                    'the animal of the day is:',
+                    'Animal': random_animal.name,
+                    'Comment': random_animal.comment,
+                    'Species': None,
+                    "Species Comment": None
+                    }
+        if random_species is not None:
+            response['Species'] = random_species['name']
+            response['Species Comment'] = random_species['description']
+
+        if ANIMAL_OF_THE_DAY_MODE == 'daily':
+            animal_of_the_day['day'] = today
+            animal_of_the_day['animal_id'] = random_animal.id
+            animal_of_the_day['response'] = response
+
+        return jsonify(response)
 
     # Get request for animals
 
     @app.route('/animals', methods=['GET'])
     @requires_auth('get:animals')
+    @coalesce
+    @conditional_get(animal_read_version)
     def get_animals(token):
-        animals = Animal.query.order_by(Animal.id).all()
-
-        # Abort if no animals are returned
-        if animals is None:
-            abort(404)
-
-        # Get all animals and format them
-        active_animals = {}
-        for animal in animals:
-            active_animals[animal.id] = animal.name
+        # the species of the detailed list come from the species cache
+        details = request.args.get('details', 'false').lower() == 'true'
+        fields = fields_arg(request, Animal.FIELDS)
+        if fields is None and details:
+            fields = Animal.FIELDS
+
+        # only the columns of the requested fields are selected, as plain
+        # rows without building Animal objects
+        sort, descending = sort_arg(request)
+        columns = Animal.columns(list(fields or ['name']) + [sort])
+        selection = filter_animals(request, Animal.query)
+
+        # the number of animals matching the filters, without filters it
+        # comes from the counter instead of a COUNT over the table
+        if has_filters(request):
+            number = selection.with_entities(func.count(Animal.id)).scalar()
+        else:
+            number = animal_counter.get()
+
+        selection = selection.with_entities(
+            *[getattr(Animal, column) for column in columns])
+        animals, next_cursor = paginate_animals(request, selection)
+
+        # Get the animals of the page and format them, as a list whenever
+        # the order matters because clients may reorder the keys of the
+        # dictionary
+        if fields is not None:
+            active_animals = [Animal.format_row(animal, fields)
+                              for animal in animals]
+        elif 'sort' in request.args:
+            active_animals = [{'id': animal.id, 'name': animal.name}
+                              for animal in animals]
+        else:
+            active_animals = {animal.id: animal.name for animal in animals}
 
         # return the dictionary of animals and the number of animals
-        return jsonify({
+        return json_response({
             'success': True,
             'animals': active_animals,
-            'number': len(animals)
+            'number': number,
+            'next_cursor': next_cursor
         })
 
+    # get request for exporting all animals
+
+    @app.route('/animals/export', methods=['GET'])
+    @requires_auth('get:animals')
+    def export_animals_table(token):
+        export_format = request.args.get('format', 'ndjson')
+        if export_format not in EXPORT_FORMATS:
+            abort(400)
+
+        return Response(
+            stream_with_context(export_animals(export_format)),
+            mimetype=EXPORT_FORMATS[export_format],
+            headers={'Content-Disposition':
+                     'attachment; filename=animals.' + export_format})
+
     # get request for a specific animal id
 
     @app.route('/animals/<int:animal_id>', methods=['GET'])
     @requires_auth('get:animals')
+    @conditional_get(animal_read_version)
     def get_animals_by_id(token, animal_id):
-        animals = Animal.query.order_by(Animal.id).all()
-        # Abort if no animals are returned
+        fields = fields_arg(request, Animal.FIELDS)
 
-        if animals is None:
-            abort(404)
-
-        animal_filtered = Animal.query.filter(
+        animal_filtered = Animal.query.options(load_only(
+            *Animal.columns(fields or ['name', 'age', 'species']))).filter(
             Animal.id == animal_id).one_or_none()
 
         if animal_filtered is None:
             abort(404)
 
-        species = Species.query.filter(
-            Species.id == animal_filtered.species_id).one_or_none()
+        if fields is not None:
+            return jsonify({
+                'success': True,
+                'animal': animal_filtered.format(fields)
+            })
+
+        animal = animal_filtered.format(['name', 'age', 'species'])
+        species = animal['species']
 
         # return the dictionary of animals and the number of animals
         return jsonify({
             'success': True,
-            'Name': animal_filtered.name,
-            'Age': animal_filtered.age,
-            'Species': species.name
+            'Name': animal['name'],
+            'Age': animal['age'],
+            'Species': species['name'] if species else None
         })
 
     # Get request for listing species
 
     @app.route('/species', methods=['GET'])
     @requires_auth('get:animals')
+    @coalesce
+    @conditional_get(species_cache.get_version)
     def get_species(token):
 
-        species = Species.query.order_by(Species.id).all()
-
-        # Abort if no species are returned
-        if species is None:
-            abort(404)
+        species = species_cache.get_all()
+        fields = fields_arg(request, Species.FIELDS)
 
-        # Format species in a dictionary
-        active_species = {}
-        for specie in species:
-            active_species[specie.id] = specie.name
+        # Format species in a dictionary or, with ?fields=, in a list
+        if fields is not None:
+            active_species = [{field: specie[field] for field in fields}
+                              for specie in species.values()]
+        else:
+            active_species = {}
+            for specie in species.values():
+                active_species[specie['id']] = specie['name']
 
         # return the dictionary of species and the number of species
-        return jsonify({
+        return json_response({
             'success': True,
             'species': active_species,
             'number': len(species)
         })
 
+    # get requests for the number of animals and their age distribution
+    # per species, computed in the database and cached until a write
+
+    @app.route('/species/stats', methods=['GET'])
+    @requires_auth('get:animals')
+    @coalesce
+    def get_species_stats(token):
+        stats = species_stats.get_all()
+        return json_response({
+            'success': True,
+            'species': [species_stats_entry(specie, stats.get(specie['id']))
+                        for specie in species_cache.get_all().values()],
+            'total_animals': sum(entry['count'] for entry in stats.values()),
+            'age_bucket_size': species_stats.bucket_size
+        })
+
+    @app.route('/species/<int:species_id>/stats', methods=['GET'])
+    @requires_auth('get:animals')
+    def get_species_stats_by_id(token, species_id):
+        specie = species_cache.get(species_id)
+        if specie is None:
+            abort(404)
+        return json_response({
+            'success': True,
+            'species': species_stats_entry(
+                specie, species_stats.get(species_id)),
+            'age_bucket_size': species_stats.bucket_size
+        })
+
     # post request for creating a new animal
 
     @app.route('/animals', methods=['POST'])
     @requires_auth('post:animals')
+    @idempotent
     def post_animal(token):
 
         body = request.get_json()
@@ -172,13 +693,7 @@ def create_app(test_config=None):
         new_species_id = body.get('species_id')
 
         # check if any required input is missing and abort
-        if new_name is None:
-            abort(400)
-        if new_age is None:
-            abort(400)
-        if new_comment is None:
-            abort(400)
-        if new_species_id is None:
+        if validate_animal(body):
             abort(400)
 
         try:
@@ -189,16 +704,14 @@ def create_app(test_config=None):
 
             animal.insert()
 
-            animals = Animal.query.order_by(Animal.id).all()
-            species = Species.query.filter(
-                Species.id == new_species_id).one_or_none()
+            species = species_cache.get(new_species_id)
 
             return jsonify({
                 'success': True,
                 'created': animal.id,
                 'animal_created': animal.name,
-                'species': species.name,
-                'total_animals': len(animals)
+                'species': species['name'],
+                'total_animals': animal_counter.get()
             })
 
         except Exception as e:
@@ -206,6 +719,84 @@ def create_app(test_config=None):
             print(sys.exc_info())
             abort(422)
 
+    # post request for creating many animals at once
+
+    @app.route('/animals/bulk', methods=['POST'])
+    @requires_auth('post:animals')
+    def post_animals_bulk(token):
+        chunk_size = request.args.get('chunk_size', BULK_CHUNK_SIZE, type=int)
+        if chunk_size < 1:
+            abort(400)
+
+        inserted = 0
+        errors = []
+        chunk = []
+
+        # rows with errors are reported and don't stop the import
+        for number, row, row_errors in read_bulk_rows():
+            if not row_errors:
+                row_errors = validate_animal(row)
+            if row_errors:
+                errors.append({'row': number, 'errors': row_errors})
+                continue
+
+            chunk.append((number, row))
+            if len(chunk) >= chunk_size:
+                chunk_inserted, chunk_errors = import_animal_chunk(chunk)
+                inserted += chunk_inserted
+                errors.extend(chunk_errors)
+                chunk = []
+
+        if chunk:
+            chunk_inserted, chunk_errors = import_animal_chunk(chunk)
+            inserted += chunk_inserted
+            errors.extend(chunk_errors)
+
+        return jsonify({
+            'success': True,
+            'inserted': inserted,
+            'errors': sorted(errors, key=lambda error: error['row']),
+            'total_animals': animal_counter.get()
+        })
+
+    # patch request for changing the age of many animals at once, sets
+    # the age or adds age_increment to it in one UPDATE
+
+    @app.route('/animals', methods=['PATCH'])
+    @requires_auth('post:animals')
+    def patch_animals_batch(token):
+        body = request.get_json(silent=True)
+        if not isinstance(body, dict):
+            abort(422)
+        selection = batch_selection(request, body)
+
+        if ('age' in body) == ('age_increment' in body):
+            abort(422)
+        value = body.get('age', body.get('age_increment'))
+        if isinstance(value, bool):
+            abort(422)
+        try:
+            value = int(value)
+        except (TypeError, ValueError):
+            abort(422)
+        if not MIN_INTEGER <= value <= MAX_INTEGER:
+            abort(422)
+        if 'age' in body:
+            age = value
+        else:
+            age = Animal.age + value
+
+        try:
+            updated = Animal.update_many(selection, {Animal.age: age})
+        except SQLAlchemyError:
+            db.session.rollback()
+            abort(422)
+
+        return jsonify({
+            'success': True,
+            'updated': updated
+        })
+
     # patch request for changing age of animal
 
     @app.route('/animals/<int:animal_id>', methods=['PATCH'])
@@ -247,13 +838,16 @@ def create_app(test_config=None):
                 abort(404)
 
             animal.delete()
-            animals = Animal.query.order_by(Animal.id).all()
+
+            # pick a new animal of the day if it was deleted
+            if animal_of_the_day['animal_id'] == animal.id:
+                animal_of_the_day['day'] = None
 
             return jsonify({
                 'success': True,
                 'deleted': animal.id,
                 'deleted name': animal.name,
-                'total_animals': len(animals)
+                'total_animals': animal_counter.get()
             })
 
         except Exception as e:
@@ -261,6 +855,69 @@ def create_app(test_config=None):
             print(sys.exc_info())
             abort(422)
 
+    # delete request for many animals at once, in one DELETE
+
+    @app.route('/animals', methods=['DELETE'])
+    @requires_auth('delete:animals')
+    def delete_animals_batch(token):
+        body = request.get_json(silent=True) or {}
+        if not isinstance(body, dict):
+            abort(422)
+        selection = batch_selection(request, body)
+
+        try:
+            deleted = Animal.delete_many(selection)
+        except SQLAlchemyError:
+            db.session.rollback()
+            abort(422)
+
+        # the animal of the day may be gone, pick it again
+        if deleted:
+            animal_of_the_day['day'] = None
+
+        return jsonify({
+            'success': True,
+            'deleted': deleted,
+            'total_animals': animal_counter.get()
+        })
+
+    # get request for the latest slow statements
+
+    @app.route('/admin/slow-queries', methods=['GET'])
+    @requires_auth('delete:animals')
+    def get_slow_queries(token):
+        return jsonify({
+            'success': True,
+            'threshold': slow_query_log.threshold,
+            'slow_queries': list(slow_query_log.entries)
+        })
+
+    # health check for the load balancer, no auth and no ORM so it stays
+    # cheap to poll
+
+    @app.route('/health', methods=['GET'])
+    def health():
+        pool = pool_status(db.engine)
+        start = time.perf_counter()
+        try:
+            with db.engine.connect() as connection:
+                connection.execute(text('SELECT 1'))
+        except SQLAlchemyError:
+            response = json_response({
+                'success': False,
+                'database': 'unavailable',
+                'pool': pool
+            }, 503)
+        else:
+            response = json_response({
+                'success': True,
+                'database': 'ok',
+                'latency_ms': round((time.perf_counter() - start) * 1000, 3),
+                'pool': pool
+            })
+        response.headers['Cache-Control'] = 'no-store'
+        return response
+
     # error handlers for all expected errors
 
     @app.errorhandler(400)
@@ -279,6 +936,14 @@ def create_app(test_config=None):
             "message": "resource not found"
         }), 404
 
+    @app.errorhandler(409)
+    def conflict(error):
+        return jsonify({
+            "success": False,
+            "error": 409,
+            "message": "conflict"
+        }), 409
+
     @app.errorhandler(422)
     def unprocessable_untity(error):
         return jsonify({
@@ -287,6 +952,18 @@ def create_app(test_config=None):
             "message": "unprocessable untity"
         }), 422
 
+    @app.errorhandler(429)
+    def too_many_requests(error):
+        response = jsonify({
+            "success": False,
+            "error": 429,
+            "message": "too many requests"
+        })
+        response.status_code = 429
+        if getattr(error, 'retry_after', None) is not None:
+            response.headers['Retry-After'] = str(error.retry_after)
+        return response
+
     @app.errorhandler(500)
     def internal_server_error(error):
         return jsonify({
@@ -298,9 +975,7 @@ def create_app(test_config=None):
     return app
 
 
-app = create_app()
-
-
 if __name__ == '__main__':
+    app = create_app()
     # app.run(host='0.0.0.0', port=8080, debug=True)
     app.run()
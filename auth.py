@@ -1,15 +1,34 @@
+import hashlib
 import json
+import logging
 import os
+import threading
+import time
+from collections import OrderedDict
 from flask import request, _request_ctx_stack, abort
 from functools import wraps
-from jose import jwt
-from urllib.request import urlopen
+from metrics import metrics
+from ratelimit import check_rate_limit
 
 
 AUTH0_DOMAIN = os.environ.get('AUTH0_DOMAIN')
 ALGORITHMS = os.environ.get('ALGORITHMS')
 API_AUDIENCE = os.environ.get('API_AUDIENCE')
 
+# JWKS source can be an https URL or a local file (path or file:// URL),
+# the local file is handy for running the tests offline
+JWKS_URL = os.environ.get('JWKS_URL',
+                          f'https://{AUTH0_DOMAIN}/.well-known/jwks.json')
+# seconds until the cached keys are fetched again
+JWKS_TTL = int(os.environ.get('JWKS_TTL', 3600))
+# minimum seconds between two refetches triggered by an unknown kid
+JWKS_MIN_REFRESH_INTERVAL = int(os.environ.get('JWKS_MIN_REFRESH_INTERVAL',
+                                               60))
+# seconds to wait for the identity provider when fetching the keys
+JWKS_FETCH_TIMEOUT = float(os.environ.get('JWKS_FETCH_TIMEOUT', 5))
+# maximum number of verified tokens kept in memory
+TOKEN_CACHE_SIZE = int(os.environ.get('TOKEN_CACHE_SIZE', 1024))
+
 
 # AuthError Exception
 '''
@@ -24,6 +43,176 @@ class AuthError(Exception):
         self.status_code = status_code
 
 
+# JWKS key store
+'''
+JWKSCache
+Keeps the signing keys of the identity provider in memory so that
+not every request has to fetch them. The keys are fetched again after
+the ttl or when a token with an unknown kid shows up, but at most once
+per min_refresh_interval so bad tokens can't force refetches. A failed
+fetch counts as well, while the provider is down the old keys are
+served and only one fetch per min_refresh_interval is tried.
+'''
+
+
+class JWKSCache:
+    def __init__(self, source, ttl=JWKS_TTL,
+                 min_refresh_interval=JWKS_MIN_REFRESH_INTERVAL,
+                 timeout=JWKS_FETCH_TIMEOUT):
+        self.source = source
+        self.ttl = ttl
+        self.min_refresh_interval = min_refresh_interval
+        self.timeout = timeout
+        self.keys = {}
+        self.fetched_at = None
+        # time of the last fetch, successful or not
+        self.last_attempt = None
+        self.fetch_count = 0
+        self.attempt_count = 0
+        self.logger = logging.getLogger('farm.jwks')
+        self._lock = threading.Lock()
+
+    def _read_source(self):
+        if self.source.startswith(('http://', 'https://')):
+            from urllib.request import urlopen
+            jsonurl = urlopen(self.source, timeout=self.timeout)
+            return json.loads(jsonurl.read())
+
+        path = self.source
+        if path.startswith('file://'):
+            path = path[len('file://'):]
+        with open(path) as jwks_file:
+            return json.load(jwks_file)
+
+    def _refresh(self):
+        jwks = self._read_source()
+        self.keys = {key['kid']: key for key in jwks['keys']}
+        self.fetched_at = time.monotonic()
+        self.fetch_count += 1
+
+    def _age(self):
+        if self.fetched_at is None:
+            return None
+        return time.monotonic() - self.fetched_at
+
+    def _may_refresh(self):
+        return self.last_attempt is None or \
+            time.monotonic() - self.last_attempt >= self.min_refresh_interval
+
+    def get_key(self, kid):
+        age = self._age()
+        if age is not None and age < self.ttl and kid in self.keys:
+            return self.keys[kid]
+        # a fetch is running or failed a moment ago, serve the old keys
+        # instead of queueing up behind the lock
+        if self.keys and not self._may_refresh():
+            return self.keys.get(kid)
+
+        # only one thread fetches, the others wait and reuse its result
+        with self._lock:
+            age = self._age()
+            expired = age is None or age >= self.ttl
+            unknown_kid = kid not in self.keys
+            if (expired or unknown_kid) and self._may_refresh():
+                self.last_attempt = time.monotonic()
+                self.attempt_count += 1
+                try:
+                    self._refresh()
+                except Exception as e:
+                    # keep serving the old keys if the provider is down
+                    if not self.keys:
+                        raise
+                    self.logger.warning(
+                        'refreshing the JWKS from %s failed, serving %d keys '
+                        'fetched %.0fs ago, next try in %ss: %r', self.source,
+                        len(self.keys), self._age(),
+                        self.min_refresh_interval, e)
+            return self.keys.get(kid)
+
+    def clear(self):
+        with self._lock:
+            self.keys = {}
+            self.fetched_at = None
+            self.last_attempt = None
+
+
+jwks_cache = JWKSCache(JWKS_URL)
+
+
+# Verified token cache
+'''
+TokenCache
+A bounded LRU cache of already verified tokens, so the RSA signature
+of a token is only checked once and not on every request. Entries are
+keyed by a hash of the token and expire at the exp claim of the token.
+'''
+
+
+class TokenCache:
+    def __init__(self, maxsize=TOKEN_CACHE_SIZE):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _key(token):
+        return hashlib.sha256(token.encode('utf-8')).hexdigest()
+
+    def get(self, token):
+        key = self._key(token)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+
+            payload, expires_at = entry
+            if expires_at <= time.time():
+                del self._entries[key]
+                self.misses += 1
+                return None
+
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return payload
+
+    def set(self, token, payload):
+        # tokens without an expiry are not cached
+        expires_at = payload.get('exp')
+        if not isinstance(expires_at, (int, float)) or self.maxsize <= 0:
+            return
+
+        key = self._key(token)
+        with self._lock:
+            self._entries[key] = (payload, expires_at)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        return {
+            'size': len(self._entries),
+            'maxsize': self.maxsize,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions
+        }
+
+
+token_cache = TokenCache()
+metrics.gauges.append(lambda: {
+    'farm_token_cache_' + name: value
+    for name, value in token_cache.stats().items()})
+
+
 # Auth Header
 
 def get_token_auth_header():
@@ -74,9 +263,9 @@ def check_permissions(permission, payload):
 
 
 def verify_decode_jwt(token):
-    # function for decoding the JWT
-    jsonurl = urlopen(f'https://{AUTH0_DOMAIN}/.well-known/jwks.json')
-    jwks = json.loads(jsonurl.read())
+    # function for decoding the JWT, jose is imported on the first call
+    # as it takes a good part of the startup of a worker
+    from jose import jwt
     unverified_header = jwt.get_unverified_header(token)
     rsa_key = {}
 
@@ -87,15 +276,15 @@ def verify_decode_jwt(token):
             'description': 'Authorization malformed.'
         }, 401)
 
-    for key in jwks['keys']:
-        if key['kid'] == unverified_header['kid']:
-            rsa_key = {
-                'kty': key['kty'],
-                'kid': key['kid'],
-                'use': key['use'],
-                'n': key['n'],
-                'e': key['e']
-            }
+    key = jwks_cache.get_key(unverified_header['kid'])
+    if key is not None:
+        rsa_key = {
+            'kty': key['kty'],
+            'kid': key['kid'],
+            'use': key['use'],
+            'n': key['n'],
+            'e': key['e']
+        }
 
     # Decode the JWT and return the payload on success
     if rsa_key:
@@ -137,18 +326,32 @@ def verify_decode_jwt(token):
             }, 400)
 
 
+def verify_decode_jwt_cached(token):
+    # returns the payload of a token verified before from the cache
+    payload = token_cache.get(token)
+    if payload is None:
+        start = time.perf_counter()
+        try:
+            payload = verify_decode_jwt(token)
+        finally:
+            metrics.observe_jwt_verify(time.perf_counter() - start)
+        token_cache.set(token, payload)
+    return payload
+
+
 def requires_auth(permission=''):
     def requires_auth_decorator(f):
         @wraps(f)
         def wrapper(*args, **kwargs):
             token = get_token_auth_header()
             try:
-                payload = verify_decode_jwt(token)
+                payload = verify_decode_jwt_cached(token)
             except Exception as e:
                 print(e)
                 abort(401)
 
             check_permissions(permission, payload)
+            check_rate_limit(payload, permission)
 
             return f(payload, *args, **kwargs)
         return wrapper
@@ -0,0 +1,220 @@
+import argparse
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+'''
+Benchmarks for the farm API
+
+They run against a temporary SQLite database, so they don't need the
+Heroku database. Set BENCHMARK_DATABASE_URL to run them against another
+database, THE BENCHMARKS DROP ALL RECORDS OF THAT DATABASE.
+Run a benchmark with e.g.:
+
+    python benchmark.py export --rows 1000000
+'''
+
+# the app has to find a database when it is imported
+DB_FILE = os.path.join(tempfile.mkdtemp(), 'benchmark.db')
+os.environ['DATABASE_URL'] = os.environ.get('BENCHMARK_DATABASE_URL',
+                                            'sqlite:///' + DB_FILE)
+
+from flask import jsonify  # noqa: E402
+from sqlalchemy import text  # noqa: E402
+from app import create_app, export_animals  # noqa: E402
+from encoders import ENCODERS  # noqa: E402
+from models import db, Animal, db_drop_and_create_all  # noqa: E402
+
+app = create_app()
+
+
+def peak_rss_mb():
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        peak = peak / 1024
+    return peak / 1024
+
+
+def seed_animals(rows, chunk_size=10000):
+    # fills the animals table in chunks so the seeding itself stays small
+    db_drop_and_create_all()
+    for start in range(0, rows, chunk_size):
+        Animal.insert_many([
+            {'name': 'Animal ' + str(number),
+             'age': number % 20,
+             'comment': 'Animal number ' + str(number) + ' of the farm',
+             'species_id': number % 4 + 1}
+            for number in range(start, min(start + chunk_size, rows))])
+
+
+def bench_export(rows):
+    with app.app_context():
+        seed_animals(rows)
+        print(f'seeded {rows} animals, peak RSS {peak_rss_mb():.1f} MB')
+
+        for export_format in ('ndjson', 'csv'):
+            before = peak_rss_mb()
+            start = time.perf_counter()
+            size = 0
+            for chunk in export_animals(export_format):
+                size += len(chunk)
+            duration = time.perf_counter() - start
+
+            print(f'export {export_format}: {size / 2 ** 20:.1f} MB in '
+                  f'{duration:.2f}s, peak RSS {peak_rss_mb():.1f} MB '
+                  f'(+{peak_rss_mb() - before:.1f} MB)')
+
+
+# the hot lookups on the animals table
+INDEX_QUERIES = (
+    ('animals of a species',
+     'SELECT id, name FROM animals WHERE species_id = :species_id '
+     'ORDER BY id LIMIT 10', {'species_id': 2}),
+    ('animals by age',
+     'SELECT id, name FROM animals WHERE age BETWEEN :low AND :high '
+     'ORDER BY age LIMIT 10', {'low': 3, 'high': 5}),
+    ('age per species',
+     'SELECT species_id, count(id), avg(age) FROM animals '
+     'WHERE species_id = :species_id GROUP BY species_id',
+     {'species_id': 2}),
+    ('name prefix',
+     'SELECT id, name FROM animals WHERE name LIKE :prefix LIMIT 10',
+     {'prefix': 'Animal 12345%'}),
+)
+
+
+def explain_queries(connection):
+    prefix = 'EXPLAIN QUERY PLAN ' if connection.dialect.name == 'sqlite' \
+        else 'EXPLAIN '
+    for name, query, parameters in INDEX_QUERIES:
+        plan = connection.execute(text(prefix + query), parameters)
+        start = time.perf_counter()
+        for repeat in range(5):
+            connection.execute(text(query), parameters).fetchall()
+        duration = (time.perf_counter() - start) / 5
+
+        print(f'  {name}: {duration * 1000:.2f} ms')
+        for row in plan:
+            print('    ' + ' '.join(str(column) for column in row))
+
+
+def bench_indexes(rows):
+    with app.app_context():
+        seed_animals(rows)
+        indexes = list(Animal.__table__.indexes)
+
+        with db.engine.connect() as connection:
+            for index in indexes:
+                index.drop(connection)
+            if connection.dialect.name == 'postgresql':
+                connection.execute('DROP INDEX IF EXISTS '
+                                   'ix_animals_name_pattern')
+                connection.execute('ANALYZE animals')
+            print(f'without indexes ({rows} animals):')
+            explain_queries(connection)
+
+            for index in indexes:
+                index.create(connection)
+            if connection.dialect.name == 'postgresql':
+                connection.execute('CREATE INDEX ix_animals_name_pattern ON '
+                                   'animals (name varchar_pattern_ops)')
+            connection.execute('ANALYZE animals')
+            print('with indexes:')
+            explain_queries(connection)
+
+
+def best_of(function, repeat=5):
+    # the fastest of some runs in milliseconds
+    durations = []
+    for run in range(repeat):
+        start = time.perf_counter()
+        function()
+        durations.append(time.perf_counter() - start)
+    return min(durations) * 1000
+
+
+def bench_encoders(rows):
+    with app.app_context():
+        seed_animals(rows)
+        columns = [getattr(Animal, column) for column in Animal.columns(
+            Animal.FIELDS)]
+
+        def orm_page():
+            return [animal.format() for animal in Animal.query.all()]
+
+        def row_page():
+            return [Animal.format_row(row) for row in
+                    Animal.query.with_entities(*columns).all()]
+
+        print(f'loading and formatting {rows} animals:')
+        print(f'  ORM objects: {best_of(orm_page):.1f} ms')
+        print(f'  row tuples:  {best_of(row_page):.1f} ms')
+
+        payload = {'success': True, 'animals': row_page(), 'number': rows}
+        print(f'encoding {rows} animals:')
+        with app.test_request_context():
+            print(f'  flask jsonify: {best_of(lambda: jsonify(payload)):.1f} '
+                  f'ms')
+        for name, encoder in sorted(ENCODERS.items()):
+            size = len(encoder(payload))
+            print(f'  {name}: {best_of(lambda: encoder(payload)):.1f} ms '
+                  f'({size / 1024:.0f} kB)')
+
+
+# runs in a fresh interpreter, prints the seconds of every startup step
+STARTUP_SCRIPT = '''
+import time
+start = time.perf_counter()
+from app import create_app
+imported = time.perf_counter()
+app = create_app()
+created = time.perf_counter()
+assert app.test_client().get('/').status_code == 200
+served = time.perf_counter()
+from jose import jwt
+print(imported - start, created - imported, served - created,
+      time.perf_counter() - served)
+'''
+
+
+def bench_startup(rows, repeat=5):
+    with app.app_context():
+        seed_animals(rows)
+
+    runs = []
+    for run in range(repeat):
+        output = subprocess.run(
+            [sys.executable, '-c', STARTUP_SCRIPT], check=True,
+            capture_output=True, text=True,
+            cwd=os.path.dirname(os.path.abspath(__file__))).stdout
+        runs.append([float(value) for value in output.split()])
+
+    # the fastest of the runs per step in milliseconds
+    steps = [min(durations) * 1000 for durations in zip(*runs)]
+    print(f'startup with {rows} animals, best of {repeat}:')
+    print(f'  import app:    {steps[0]:.1f} ms')
+    print(f'  create_app():  {steps[1]:.1f} ms')
+    print(f'  first request: {steps[2]:.1f} ms')
+    print(f'  total:         {sum(steps[:3]):.1f} ms')
+    print(f'  jose, on the first token: {steps[3]:.1f} ms')
+
+
+BENCHMARKS = {
+    'encoders': bench_encoders,
+    'export': bench_export,
+    'indexes': bench_indexes,
+    'startup': bench_startup
+}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmarks for the API')
+    parser.add_argument('benchmark', choices=sorted(BENCHMARKS))
+    parser.add_argument('--rows', type=int, default=1000000)
+    args = parser.parse_args()
+
+    BENCHMARKS[args.benchmark](args.rows)
@@ -0,0 +1,102 @@
+import os
+import threading
+from functools import wraps
+from flask import current_app, make_response, request, Response
+from metrics import metrics
+
+'''
+Request coalescing
+
+Identical GET requests that arrive while the first of them is still
+running wait for it and get a copy of its response instead of running
+the same queries again. Requests are identical when they have the same
+app, path, query arguments, If-None-Match header and token permissions.
+A waiting request that doesn't get the response within the timeout, or
+whose first request failed, runs the handler itself.
+'''
+
+# seconds a request waits for the identical request in flight, 0 turns
+# the coalescing off
+COALESCE_TIMEOUT = float(os.environ.get('COALESCE_TIMEOUT', 5))
+
+
+class Call:
+    def __init__(self):
+        self.done = threading.Event()
+        self.response = None
+
+
+class SingleFlight:
+    def __init__(self, timeout=COALESCE_TIMEOUT):
+        self.timeout = timeout
+        self.calls = {}
+        self.leaders = 0
+        self.shared = 0
+        self.timeouts = 0
+        self._lock = threading.Lock()
+
+    def do(self, key, function):
+        # returns the (body, status, headers) of function, run once for
+        # all concurrent callers with the same key
+        if self.timeout <= 0:
+            return function()
+
+        with self._lock:
+            call = self.calls.get(key)
+            leader = call is None
+            if leader:
+                call = self.calls[key] = Call()
+                self.leaders += 1
+
+        if not leader:
+            if call.done.wait(self.timeout) and call.response is not None:
+                with self._lock:
+                    self.shared += 1
+                return call.response
+            with self._lock:
+                self.timeouts += 1
+            return function()
+
+        try:
+            call.response = function()
+        finally:
+            with self._lock:
+                del self.calls[key]
+            call.done.set()
+        return call.response
+
+    def stats(self):
+        with self._lock:
+            return {
+                'in_flight': len(self.calls),
+                'leaders': self.leaders,
+                'shared': self.shared,
+                'timeouts': self.timeouts
+            }
+
+
+single_flight = SingleFlight()
+metrics.gauges.append(lambda: {
+    'farm_coalesced_requests_' + name: value
+    for name, value in single_flight.stats().items()})
+
+
+def coalesce(f):
+    # goes below requires_auth, the permissions of the token are part of
+    # the key
+    @wraps(f)
+    def wrapper(token, *args, **kwargs):
+        key = (id(current_app._get_current_object()), request.path,
+               tuple(sorted(request.args.items(multi=True))),
+               request.headers.get('If-None-Match'),
+               tuple(sorted(token.get('permissions', []))))
+
+        def run():
+            response = make_response(f(token, *args, **kwargs))
+            return (response.get_data(), response.status_code,
+                    list(response.headers.items()))
+
+        body, status, headers = single_flight.do(key, run)
+        return Response(body, status=status, headers=headers)
+
+    return wrapper
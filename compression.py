@@ -0,0 +1,130 @@
+import gzip
+import hashlib
+import os
+import threading
+import zlib
+from collections import OrderedDict
+from flask import request
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+'''
+Response compression
+
+Compresses the responses above a minimum size with the best encoding
+the client accepts: br (when the brotli package is installed), gzip or
+deflate. Streamed responses like the export are compressed chunk by
+chunk. The compressed bodies are cached by a digest of the body, an
+ETag is not enough as the ETags of the animals follow the version of
+the table and not the content.
+'''
+
+# responses smaller than this many bytes are sent uncompressed
+COMPRESSION_MIN_SIZE = int(os.environ.get('COMPRESSION_MIN_SIZE', 500))
+COMPRESSION_LEVEL = int(os.environ.get('COMPRESSION_LEVEL', 6))
+# number of compressed bodies kept in memory
+COMPRESSION_CACHE_SIZE = int(os.environ.get('COMPRESSION_CACHE_SIZE', 64))
+
+COMPRESSIBLE_MIMETYPES = ('application/json', 'application/x-ndjson',
+                          'text/csv', 'text/plain')
+
+ENCODINGS = ['gzip', 'deflate']
+if brotli is not None:
+    ENCODINGS.insert(0, 'br')
+
+
+def compress(data, encoding, level=COMPRESSION_LEVEL):
+    if encoding == 'br':
+        return brotli.compress(data, quality=min(level, 11))
+    if encoding == 'gzip':
+        return gzip.compress(data, compresslevel=level)
+    return zlib.compress(data, level)
+
+
+def compress_stream(chunks, encoding, level=COMPRESSION_LEVEL):
+    # compresses every chunk on its own so the client gets them right away
+    if encoding == 'br':
+        compressor = brotli.Compressor(quality=min(level, 11))
+        for chunk in chunks:
+            if isinstance(chunk, str):
+                chunk = chunk.encode('utf-8')
+            yield compressor.process(chunk) + compressor.flush()
+        yield compressor.finish()
+        return
+
+    wbits = 31 if encoding == 'gzip' else 15
+    compressor = zlib.compressobj(level, zlib.DEFLATED, wbits)
+    for chunk in chunks:
+        if isinstance(chunk, str):
+            chunk = chunk.encode('utf-8')
+        yield compressor.compress(chunk) + compressor.flush(zlib.Z_SYNC_FLUSH)
+    yield compressor.flush()
+
+
+def etag_variants(etag):
+    # a compressed response gets its own strong ETag per encoding
+    return [etag] + [etag + '-' + encoding for encoding in ENCODINGS]
+
+
+class CompressedCache:
+    def __init__(self, maxsize=COMPRESSION_CACHE_SIZE):
+        self.maxsize = maxsize
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            data = self._entries.get(key)
+            if data is not None:
+                self._entries.move_to_end(key)
+            return data
+
+    def set(self, key, data):
+        with self._lock:
+            self._entries[key] = data
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+
+compressed_cache = CompressedCache()
+
+
+def init_compression(app, min_size=COMPRESSION_MIN_SIZE):
+    @app.after_request
+    def compress_response(response):
+        if response.status_code < 200 or response.status_code in (204, 304) \
+                or 'Content-Encoding' in response.headers \
+                or response.mimetype not in COMPRESSIBLE_MIMETYPES:
+            return response
+
+        response.vary.add('Accept-Encoding')
+        encoding = request.accept_encodings.best_match(ENCODINGS)
+        if encoding is None:
+            return response
+
+        if response.is_streamed:
+            response.response = compress_stream(response.response, encoding)
+            response.headers.pop('Content-Length', None)
+            response.headers['Content-Encoding'] = encoding
+            return response
+
+        data = response.get_data()
+        if len(data) < min_size:
+            return response
+
+        key = (hashlib.sha1(data).digest(), encoding)
+        compressed = compressed_cache.get(key)
+        if compressed is None:
+            compressed = compress(data, encoding)
+            compressed_cache.set(key, compressed)
+
+        etag, weak = response.get_etag()
+        if etag is not None:
+            response.set_etag(etag + '-' + encoding, weak)
+        response.set_data(compressed)
+        response.headers['Content-Encoding'] = encoding
+        return response
@@ -0,0 +1,55 @@
+import json
+import os
+from flask import current_app, Response
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+'''
+Response encoders
+
+Serialize the data of a response straight to bytes. orjson is used when
+it is installed, else the standard library json. create_app picks one
+with the RESPONSE_ENCODER setting ('orjson', 'json' or a callable).
+'''
+
+
+def json_encoder(data):
+    return json.dumps(data, separators=(',', ':')).encode('utf-8')
+
+
+def orjson_encoder(data):
+    # dictionary keys like the animal ids are integers
+    return orjson.dumps(data, option=orjson.OPT_NON_STR_KEYS)
+
+
+ENCODERS = {
+    'json': json_encoder
+}
+if orjson is not None:
+    ENCODERS['orjson'] = orjson_encoder
+
+DEFAULT_ENCODER = os.environ.get(
+    'RESPONSE_ENCODER', 'orjson' if orjson is not None else 'json')
+
+
+def get_encoder(encoder):
+    if callable(encoder):
+        return encoder
+    if encoder not in ENCODERS:
+        raise ValueError('unknown response encoder: {}'.format(encoder))
+    return ENCODERS[encoder]
+
+
+def init_encoder(app):
+    app.config['RESPONSE_ENCODER'] = get_encoder(
+        app.config.get('RESPONSE_ENCODER', DEFAULT_ENCODER))
+
+
+def json_response(data, status=200):
+    # like jsonify, but with the encoder of the app and without sorting
+    # or indenting the keys
+    return Response(current_app.config['RESPONSE_ENCODER'](data),
+                    status=status, mimetype='application/json')
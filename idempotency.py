@@ -0,0 +1,197 @@
+import hashlib
+import os
+import threading
+import time
+from collections import OrderedDict
+from functools import wraps
+from flask import abort, current_app, make_response, request, Response
+from sqlalchemy.exc import IntegrityError
+from models import db, IdempotencyKey
+
+'''
+Idempotency keys
+
+A POST request with an Idempotency-Key header is run once. Retries with
+the same key, token and body get the stored response of the first
+request back without touching the animals table, a retry with another
+body is refused with 422 and one arriving while the first request is
+still running with 409. Only successful responses are stored, a failed
+request can be retried with the same key. A running request holds its key
+for IDEMPOTENCY_LEASE seconds only, so the key of a worker that died
+midway is free again soon, the stored response is kept for
+IDEMPOTENCY_TTL seconds.
+
+The keys are kept in memory by default. Set IDEMPOTENCY_STORE to
+'database' to share them between the workers in the idempotency_keys
+table.
+'''
+
+# 'memory' or 'database'
+IDEMPOTENCY_STORE = os.environ.get('IDEMPOTENCY_STORE', 'memory')
+# seconds a key and its response are kept
+IDEMPOTENCY_TTL = int(os.environ.get('IDEMPOTENCY_TTL', 86400))
+# seconds a key is held by a request still running, keep it above the
+# longest request
+IDEMPOTENCY_LEASE = int(os.environ.get('IDEMPOTENCY_LEASE', 60))
+# maximum number of keys kept in memory
+IDEMPOTENCY_STORE_SIZE = int(os.environ.get('IDEMPOTENCY_STORE_SIZE',
+                                            10000))
+# expired keys are deleted from the database every this many new keys
+IDEMPOTENCY_PURGE_INTERVAL = 100
+MAX_KEY_LENGTH = 255
+
+
+class MemoryIdempotencyStore:
+    def __init__(self, ttl=IDEMPOTENCY_TTL, maxsize=IDEMPOTENCY_STORE_SIZE,
+                 lease=IDEMPOTENCY_LEASE):
+        self.ttl = ttl
+        self.lease = lease
+        self.maxsize = maxsize
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def reserve(self, key, fingerprint):
+        # returns the entry of the key, or None if the caller got the key
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry['expires_at'] > now:
+                return entry
+            self._entries[key] = {'fingerprint': fingerprint, 'status': None,
+                                  'expires_at': now + self.lease}
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+        return None
+
+    def save(self, key, response):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                entry.update(status=response.status_code,
+                             mimetype=response.mimetype,
+                             body=response.get_data(),
+                             expires_at=time.time() + self.ttl)
+
+    def release(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+
+class DatabaseIdempotencyStore:
+    def __init__(self, ttl=IDEMPOTENCY_TTL,
+                 purge_interval=IDEMPOTENCY_PURGE_INTERVAL,
+                 lease=IDEMPOTENCY_LEASE):
+        self.ttl = ttl
+        self.lease = lease
+        self.purge_interval = purge_interval
+        self.reservations = 0
+        self.table = IdempotencyKey.__table__
+
+    def reserve(self, key, fingerprint):
+        # the primary key decides which worker gets the key, an expired
+        # key is deleted and reserved again once
+        table = self.table
+        now = int(time.time())
+        for attempt in range(2):
+            try:
+                with db.engine.begin() as connection:
+                    connection.execute(table.insert().values(
+                        key=key, fingerprint=fingerprint,
+                        expires_at=now + self.lease))
+                self.purge(now)
+                return None
+            except IntegrityError:
+                pass
+
+            with db.engine.begin() as connection:
+                row = connection.execute(table.select().where(
+                    table.c.key == key)).first()
+                if row is not None and row.expires_at > now:
+                    return dict(row)
+                connection.execute(table.delete().where(
+                    table.c.key == key).where(table.c.expires_at <= now))
+
+        # lost the race for the key twice, treat it as still running
+        return {'fingerprint': fingerprint, 'status': None}
+
+    def save(self, key, response):
+        with db.engine.begin() as connection:
+            connection.execute(self.table.update().where(
+                self.table.c.key == key).values(
+                    status=response.status_code,
+                    mimetype=response.mimetype,
+                    body=response.get_data(),
+                    expires_at=int(time.time()) + self.ttl))
+
+    def release(self, key):
+        with db.engine.begin() as connection:
+            connection.execute(self.table.delete().where(
+                self.table.c.key == key))
+
+    def purge(self, now):
+        self.reservations += 1
+        if self.reservations % self.purge_interval == 0:
+            with db.engine.begin() as connection:
+                connection.execute(self.table.delete().where(
+                    self.table.c.expires_at <= now))
+
+
+STORES = {
+    'memory': MemoryIdempotencyStore,
+    'database': DatabaseIdempotencyStore
+}
+
+
+def get_store(store):
+    if hasattr(store, 'reserve'):
+        return store
+    if store not in STORES:
+        raise ValueError('unknown idempotency store: {}'.format(store))
+    return STORES[store]()
+
+
+def init_idempotency(app):
+    app.config['IDEMPOTENCY_STORE'] = get_store(
+        app.config.get('IDEMPOTENCY_STORE', IDEMPOTENCY_STORE))
+
+
+def idempotent(f):
+    # goes below requires_auth, the keys are per token subject
+    @wraps(f)
+    def wrapper(token, *args, **kwargs):
+        header = request.headers.get('Idempotency-Key')
+        if header is None:
+            return f(token, *args, **kwargs)
+        if not header or len(header) > MAX_KEY_LENGTH:
+            abort(400)
+
+        key = hashlib.sha256('|'.join((
+            str(token.get('sub')), request.method, request.path, header
+            )).encode('utf-8')).hexdigest()
+        fingerprint = hashlib.sha256(request.get_data()).hexdigest()
+        store = current_app.config['IDEMPOTENCY_STORE']
+
+        entry = store.reserve(key, fingerprint)
+        if entry is not None:
+            if entry['fingerprint'] != fingerprint:
+                abort(422)
+            if entry['status'] is None:
+                abort(409)
+            response = Response(entry['body'], status=entry['status'],
+                                mimetype=entry['mimetype'])
+            response.headers['Idempotent-Replayed'] = 'true'
+            return response
+
+        try:
+            response = make_response(f(token, *args, **kwargs))
+        except Exception:
+            store.release(key)
+            raise
+        if 200 <= response.status_code < 300:
+            store.save(key, response)
+        else:
+            store.release(key)
+        return response
+
+    return wrapper
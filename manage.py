@@ -1,13 +1,23 @@
-from flask_script import Manager
+from flask_script import Manager, Command
 from flask_migrate import Migrate, MigrateCommand
 
-from app import app
+from app import create_app
 from models import db
 
+app = create_app()
 migrate = Migrate(app, db)
 manager = Manager(app)
 
+
+class CreateDB(Command):
+    '''Creates the tables that don't exist yet'''
+
+    def run(self):
+        db.create_all()
+
+
 manager.add_command('db', MigrateCommand)
+manager.add_command('create_db', CreateDB())
 
 
 if __name__ == '__main__':
@@ -0,0 +1,156 @@
+import bisect
+import threading
+import time
+from flask import g, request, has_request_context, Response
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+'''
+Request metrics
+
+Records per route the latency, the status codes and the number and
+time of the SQL statements of every request, plus the time spent
+verifying tokens. init_metrics(app) exposes them at /metrics in the
+Prometheus text format.
+'''
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0,
+                   10.0)
+
+
+class Histogram:
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        # the last count is for the values above the largest bucket
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def lines(self, name, labels):
+        lines = []
+        cumulative = 0
+        for bucket, count in zip(self.buckets, self.counts):
+            cumulative += count
+            lines.append('{}_bucket{{{}le="{}"}} {}'.format(
+                name, labels, bucket, cumulative))
+        lines.append('{}_bucket{{{}le="+Inf"}} {}'.format(
+            name, labels, self.count))
+        labels = '{' + labels.rstrip(',') + '}' if labels else ''
+        lines.append('{}_sum{} {}'.format(name, labels, self.sum))
+        lines.append('{}_count{} {}'.format(name, labels, self.count))
+        return lines
+
+
+class Metrics:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.latency = {}
+        self.responses = {}
+        self.sql_statements = {}
+        self.sql_seconds = {}
+        self.jwt_verify = Histogram()
+        # callables returning {name: value} for extra gauges
+        self.gauges = []
+
+    def observe_request(self, route, method, status, duration,
+                        statements, sql_seconds):
+        key = (route, method)
+        with self._lock:
+            if key not in self.latency:
+                self.latency[key] = Histogram()
+                self.sql_statements[key] = 0
+                self.sql_seconds[key] = 0.0
+            self.latency[key].observe(duration)
+            self.sql_statements[key] += statements
+            self.sql_seconds[key] += sql_seconds
+            status_key = (route, method, status)
+            self.responses[status_key] = self.responses.get(status_key, 0) + 1
+
+    def observe_jwt_verify(self, duration):
+        with self._lock:
+            self.jwt_verify.observe(duration)
+
+    def render(self):
+        lines = []
+        with self._lock:
+            lines.append('# TYPE farm_request_duration_seconds histogram')
+            for (route, method), histogram in sorted(self.latency.items()):
+                lines.extend(histogram.lines(
+                    'farm_request_duration_seconds',
+                    'route="{}",method="{}",'.format(route, method)))
+
+            lines.append('# TYPE farm_responses_total counter')
+            for (route, method, status), count in sorted(
+                    self.responses.items()):
+                lines.append('farm_responses_total{{route="{}",method="{}",'
+                             'status="{}"}} {}'.format(route, method, status,
+                                                       count))
+
+            lines.append('# TYPE farm_sql_statements_total counter')
+            for (route, method), count in sorted(self.sql_statements.items()):
+                lines.append('farm_sql_statements_total{{route="{}",'
+                             'method="{}"}} {}'.format(route, method, count))
+
+            lines.append('# TYPE farm_sql_seconds_total counter')
+            for (route, method), seconds in sorted(self.sql_seconds.items()):
+                lines.append('farm_sql_seconds_total{{route="{}",'
+                             'method="{}"}} {}'.format(route, method, seconds))
+
+            lines.append('# TYPE farm_jwt_verify_seconds histogram')
+            lines.extend(self.jwt_verify.lines('farm_jwt_verify_seconds', ''))
+
+        for gauges in self.gauges:
+            for name, value in sorted(gauges().items()):
+                lines.append('# TYPE {} gauge'.format(name))
+                lines.append('{} {}'.format(name, value))
+
+        return '\n'.join(lines) + '\n'
+
+
+metrics = Metrics()
+
+
+# SQL statements are counted on every engine, the count of the current
+# request is kept in g
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def before_cursor_execute(conn, cursor, statement, parameters, context,
+                          executemany):
+    conn.info['query_start_time'] = time.perf_counter()
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def after_cursor_execute(conn, cursor, statement, parameters, context,
+                         executemany):
+    duration = time.perf_counter() - conn.info['query_start_time']
+    if has_request_context() and 'sql_statements' in g:
+        g.sql_statements += 1
+        g.sql_seconds += duration
+
+
+def init_metrics(app):
+    @app.before_request
+    def start_request_metrics():
+        g.request_start_time = time.perf_counter()
+        g.sql_statements = 0
+        g.sql_seconds = 0.0
+
+    @app.after_request
+    def record_request_metrics(response):
+        if 'request_start_time' in g:
+            route = request.url_rule.rule if request.url_rule else 'unmatched'
+            metrics.observe_request(
+                route, request.method, response.status_code,
+                time.perf_counter() - g.request_start_time,
+                g.sql_statements, g.sql_seconds)
+        return response
+
+    @app.route('/metrics', methods=['GET'])
+    def get_metrics():
+        return Response(metrics.render(),
+                        mimetype='text/plain; version=0.0.4')
@@ -0,0 +1,43 @@
+"""add indexes for the animal lookups
+
+Revision ID: 3c5a1f0e9b2d
+Revises:
+Create Date: 2026-10-18 09:12:44.318027
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '3c5a1f0e9b2d'
+down_revision = None
+branch_labels = None
+depends_on = None
+
+
+def existing_indexes():
+    # create_all() already creates the indexes on a new database
+    inspector = sa.inspect(op.get_bind())
+    return {index['name'] for index in inspector.get_indexes('animals')}
+
+
+def upgrade():
+    indexes = existing_indexes()
+    if 'ix_animals_species_id_age' not in indexes:
+        op.create_index('ix_animals_species_id_age', 'animals',
+                        ['species_id', 'age'])
+    if 'ix_animals_age' not in indexes:
+        op.create_index('ix_animals_age', 'animals', ['age'])
+    if op.get_bind().dialect.name == 'postgresql' and \
+            'ix_animals_name_pattern' not in indexes:
+        op.execute('CREATE INDEX ix_animals_name_pattern ON animals '
+                   '(name varchar_pattern_ops)')
+
+
+def downgrade():
+    indexes = existing_indexes()
+    if 'ix_animals_name_pattern' in indexes:
+        op.drop_index('ix_animals_name_pattern', table_name='animals')
+    op.drop_index('ix_animals_age', table_name='animals')
+    op.drop_index('ix_animals_species_id_age', table_name='animals')
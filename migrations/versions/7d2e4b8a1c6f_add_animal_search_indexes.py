@@ -0,0 +1,34 @@
+"""add trigram indexes for the animal search
+
+Revision ID: 7d2e4b8a1c6f
+Revises: 3c5a1f0e9b2d
+Create Date: 2026-10-18 10:03:17.552104
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '7d2e4b8a1c6f'
+down_revision = '3c5a1f0e9b2d'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # only PostgreSQL has trigram indexes, SQLite searches with LIKE
+    if op.get_bind().dialect.name != 'postgresql':
+        return
+    op.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+    op.execute('CREATE INDEX IF NOT EXISTS ix_animals_name_trgm ON animals '
+               'USING gin (name gin_trgm_ops)')
+    op.execute('CREATE INDEX IF NOT EXISTS ix_animals_comment_trgm ON '
+               'animals USING gin (comment gin_trgm_ops)')
+
+
+def downgrade():
+    if op.get_bind().dialect.name != 'postgresql':
+        return
+    op.execute('DROP INDEX IF EXISTS ix_animals_comment_trgm')
+    op.execute('DROP INDEX IF EXISTS ix_animals_name_trgm')
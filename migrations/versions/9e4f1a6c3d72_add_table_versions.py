@@ -0,0 +1,32 @@
+"""add the table versions used for the ETags
+
+Revision ID: 9e4f1a6c3d72
+Revises: 5b9c3e7f2a41
+Create Date: 2026-10-18 16:05:12.730914
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '9e4f1a6c3d72'
+down_revision = '5b9c3e7f2a41'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # create_db may have created the table already
+    if 'table_versions' in sa.inspect(op.get_bind()).get_table_names():
+        return
+    table_versions = op.create_table(
+        'table_versions',
+        sa.Column('name', sa.String(length=50), nullable=False),
+        sa.Column('version', sa.Integer(), nullable=False),
+        sa.PrimaryKeyConstraint('name'))
+    op.bulk_insert(table_versions, [{'name': 'animals', 'version': 0}])
+
+
+def downgrade():
+    op.drop_table('table_versions')
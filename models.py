@@ -1,10 +1,31 @@
 import os
 import json
-from flask import Flask
-from sqlalchemy import Column, String, Integer, ForeignKey, create_engine
-from sqlalchemy.orm import relationship
-from flask_migrate import Migrate
-from flask_sqlalchemy import SQLAlchemy
+import hashlib
+import itertools
+import logging
+import threading
+import time
+import traceback
+from collections import deque
+from flask import Flask, request, has_request_context
+from sqlalchemy import (
+    Column,
+    String,
+    Integer,
+    LargeBinary,
+    ForeignKey,
+    Index,
+    DDL,
+    create_engine,
+    event,
+    func,
+    literal_column,
+    select
+    )
+from sqlalchemy.engine.url import make_url
+from sqlalchemy.orm import relationship, sessionmaker
+from sqlalchemy.sql.expression import UpdateBase
+from flask_sqlalchemy import SQLAlchemy, SignallingSession, get_state
 
 '''
 DB_HOST = os.getenv('DB_HOST', '127.0.0.1:5432')
@@ -19,8 +40,177 @@ DB_PATH = 'postgresql+psycopg2://{}:{}@{}/{}'.format(
 # Heroku DB
 # DB_PATH = os.environ('DB_PATH')
 DB_PATH = os.environ.get('DATABASE_URL')
+# comma separated read replicas of the database, the GET requests read
+# from them in turn
+DB_REPLICA_PATHS = [path.strip() for path in
+                    os.environ.get('DATABASE_REPLICA_URLS', '').split(',')
+                    if path.strip()]
+# seconds until a maintained row count is checked against COUNT(*) again,
+# needed because other workers insert and delete as well
+ROW_COUNT_TTL = int(os.environ.get('ROW_COUNT_TTL', 60))
+# seconds until the species catalogue is read again from the database,
+# a safety net for changes made by other workers
+SPECIES_CACHE_TTL = int(os.environ.get('SPECIES_CACHE_TTL', 300))
+# seconds until the species statistics are computed again, they are
+# also computed again after every write through the Animal methods
+STATS_CACHE_TTL = int(os.environ.get('STATS_CACHE_TTL', 60))
+# years per bucket of the age histogram of the species statistics
+STATS_AGE_BUCKET_SIZE = int(os.environ.get('STATS_AGE_BUCKET_SIZE', 5))
+# statements slower than this many seconds are logged, unset to turn off
+SLOW_QUERY_THRESHOLD = os.environ.get('SLOW_QUERY_THRESHOLD')
+# set to 'true' to also capture the EXPLAIN output of slow statements
+SLOW_QUERY_EXPLAIN = os.environ.get('SLOW_QUERY_EXPLAIN', 'false') == 'true'
+# number of slow statements kept for the admin endpoint
+SLOW_QUERY_BUFFER_SIZE = int(os.environ.get('SLOW_QUERY_BUFFER_SIZE', 50))
+# connection pool of the engine, the pool settings are ignored for SQLite
+# which opens a connection per checkout
+DB_POOL_SIZE = int(os.environ.get('DB_POOL_SIZE', 5))
+DB_MAX_OVERFLOW = int(os.environ.get('DB_MAX_OVERFLOW', 10))
+# seconds to wait for a free connection before giving up
+DB_POOL_TIMEOUT = int(os.environ.get('DB_POOL_TIMEOUT', 30))
+# seconds after which a connection is replaced, keep it below the idle
+# timeout of the database server
+DB_POOL_RECYCLE = int(os.environ.get('DB_POOL_RECYCLE', 1800))
+# set to 'false' to skip testing a connection when it is checked out
+DB_POOL_PRE_PING = os.environ.get('DB_POOL_PRE_PING', 'true') == 'true'
+# milliseconds a statement may run on PostgreSQL, 0 for no limit
+DB_STATEMENT_TIMEOUT = int(os.environ.get('DB_STATEMENT_TIMEOUT', 0))
+
+PROJECT_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+'''
+RoutingSession
+The session of a request. Reads of GET and HEAD requests go to one of
+the read replicas, picked in turn per request. Everything else goes to
+the primary: writes, all statements of other requests and the reads
+that follow a write in the same request, so a request always sees its
+own changes.
+'''
+
+READ_METHODS = ('GET', 'HEAD')
+# picks the replica of the next request
+replica_counter = itertools.count()
+
+
+class RoutingSession(SignallingSession):
+    def __init__(self, db, **options):
+        super().__init__(db, **options)
+        self.use_primary = False
+        self._replica = None
+
+    def get_bind(self, mapper=None, clause=None):
+        if self._flushing or isinstance(clause, UpdateBase):
+            self.use_primary = True
+        replicas = self.app.config.get('DATABASE_REPLICAS')
+        if self.use_primary or not replicas or not has_request_context() \
+                or request.method not in READ_METHODS:
+            return super().get_bind(mapper, clause)
+
+        if self._replica is None:
+            bind = replicas[next(replica_counter) % len(replicas)]
+            self._replica = get_state(self.app).db.get_engine(
+                self.app, bind=bind)
+        return self._replica
+
 
-db = SQLAlchemy()
+class RoutingSQLAlchemy(SQLAlchemy):
+    def create_session(self, options):
+        return sessionmaker(class_=RoutingSession, db=self, **options)
+
+
+db = RoutingSQLAlchemy()
+
+
+'''
+SlowQueryLog
+Logs every statement slower than the threshold with its parameters, the
+route of the request and the line of our code that issued it. The
+latest slow statements, optionally with their EXPLAIN output, are kept
+in a ring buffer.
+'''
+
+
+class SlowQueryLog:
+    def __init__(self, threshold=None, explain=False,
+                 size=SLOW_QUERY_BUFFER_SIZE):
+        self.threshold = threshold
+        self.explain = explain
+        self.entries = deque(maxlen=size)
+        self.logger = logging.getLogger('farm.slow_query')
+
+    def configure(self, threshold, explain):
+        self.threshold = float(threshold) if threshold is not None else None
+        self.explain = explain
+
+    def attach(self, engine):
+        if not event.contains(engine, 'before_cursor_execute',
+                              self.before_cursor_execute):
+            event.listen(engine, 'before_cursor_execute',
+                         self.before_cursor_execute)
+            event.listen(engine, 'after_cursor_execute',
+                         self.after_cursor_execute)
+
+    def before_cursor_execute(self, conn, cursor, statement, parameters,
+                              context, executemany):
+        conn.info['slow_query_start_time'] = time.perf_counter()
+
+    def after_cursor_execute(self, conn, cursor, statement, parameters,
+                             context, executemany):
+        if self.threshold is None:
+            return
+        duration = time.perf_counter() - conn.info['slow_query_start_time']
+        if duration < self.threshold:
+            return
+
+        entry = {
+            'statement': statement,
+            'parameters': repr(parameters),
+            'duration': duration,
+            'route': request.url_rule.rule
+            if has_request_context() and request.url_rule else None,
+            'call_site': self.call_site(),
+            'plan': None
+        }
+        if self.explain and not executemany and \
+                statement.lstrip().upper().startswith('SELECT'):
+            entry['plan'] = self.explain_statement(conn, statement,
+                                                   parameters)
+
+        self.logger.warning('slow query (%.3fs) on %s from %s: %s %s',
+                            duration, entry['route'], entry['call_site'],
+                            statement, entry['parameters'])
+        self.entries.append(entry)
+
+    @staticmethod
+    def call_site():
+        # the innermost frame of our own code that issued the statement,
+        # without the frames of this hook
+        for frame in reversed(traceback.extract_stack()[:-2]):
+            if frame.filename.startswith(PROJECT_DIR) and \
+                    'site-packages' not in frame.filename:
+                return '{}:{} in {}'.format(
+                    os.path.basename(frame.filename), frame.lineno,
+                    frame.name)
+        return None
+
+    @staticmethod
+    def explain_statement(conn, statement, parameters):
+        # a separate cursor, the results of the statement are still unread
+        prefix = 'EXPLAIN QUERY PLAN ' if conn.dialect.name == 'sqlite' \
+            else 'EXPLAIN '
+        cursor = conn.connection.cursor()
+        try:
+            cursor.execute(prefix + statement, parameters)
+            return [' '.join(str(column) for column in row)
+                    for row in cursor.fetchall()]
+        except Exception as e:
+            return ['EXPLAIN failed: ' + str(e)]
+        finally:
+            cursor.close()
+
+
+slow_query_log = SlowQueryLog()
 
 
 '''
@@ -28,12 +218,79 @@ Binds a flask application and also a SQLAlchemy service
 '''
 
 
-def setup_db(app, database_path=DB_PATH):
+def setup_db(app, database_path=DB_PATH,
+             slow_query_threshold=SLOW_QUERY_THRESHOLD,
+             explain_slow_queries=SLOW_QUERY_EXPLAIN):
     app.config["SQLALCHEMY_DATABASE_URI"] = database_path
     app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
+    # options given by the app config win over the environment
+    app.config.setdefault("SQLALCHEMY_ENGINE_OPTIONS",
+                          engine_options(database_path))
+    # the replicas are binds without tables of their own, only the
+    # RoutingSession reads from them
+    replica_paths = app.config.setdefault("DATABASE_REPLICA_URLS",
+                                          DB_REPLICA_PATHS)
+    replicas = ['replica_{}'.format(number)
+                for number in range(len(replica_paths))]
+    app.config["DATABASE_REPLICAS"] = replicas
+    if replicas:
+        binds = app.config.setdefault("SQLALCHEMY_BINDS", {})
+        binds.update(zip(replicas, replica_paths))
     db.app = app
     db.init_app(app)
-    db.create_all()
+    # opt-in slow query log, off as long as no threshold is given
+    slow_query_log.configure(slow_query_threshold, explain_slow_queries)
+    if slow_query_threshold is not None:
+        for bind in [None] + replicas:
+            slow_query_log.attach(db.get_engine(app, bind=bind))
+
+
+'''
+engine_options(database_path)
+    the options for the engine and its connection pool
+'''
+
+
+def engine_options(database_path, pool_size=DB_POOL_SIZE,
+                   max_overflow=DB_MAX_OVERFLOW,
+                   pool_timeout=DB_POOL_TIMEOUT,
+                   pool_recycle=DB_POOL_RECYCLE,
+                   pool_pre_ping=DB_POOL_PRE_PING,
+                   statement_timeout=DB_STATEMENT_TIMEOUT):
+    options = {'pool_pre_ping': pool_pre_ping}
+    backend = make_url(database_path).get_backend_name()
+    if backend == 'sqlite':
+        return options
+
+    options.update({
+        'pool_size': pool_size,
+        'max_overflow': max_overflow,
+        'pool_timeout': pool_timeout,
+        'pool_recycle': pool_recycle
+    })
+    if statement_timeout and backend in ('postgresql', 'postgres'):
+        # set for every new connection, a slow statement is cancelled
+        # instead of holding its connection
+        options['connect_args'] = {
+            'options': '-c statement_timeout={}'.format(statement_timeout)}
+    return options
+
+
+'''
+pool_status(engine)
+    the size and usage of the connection pool of the engine, None for
+    the numbers a pool doesn't keep like the SQLite one
+'''
+
+
+def pool_status(engine):
+    pool = engine.pool
+    status = {'pool': type(pool).__name__}
+    for name in ('size', 'checkedin', 'checkedout', 'overflow'):
+        counter = getattr(pool, name, None)
+        # the SQLite pool of an in-memory database keeps its size as is
+        status[name] = counter() if callable(counter) else counter
+    return status
 
 
 '''
@@ -46,6 +303,9 @@ db_drop_and_create_all()
 def db_drop_and_create_all():
     db.drop_all()
     db.create_all()
+    animal_counter.reset()
+    species_cache.invalidate()
+    species_stats.invalidate()
     db_create_species()
     db_create_animals()
 
@@ -70,20 +330,22 @@ class Species(db.Model):
     def insert(self):
         db.session.add(self)
         db.session.commit()
+        species_cache.invalidate()
 
     def update(self):
         db.session.commit()
+        species_cache.invalidate()
 
     def delete(self):
         db.session.delete(self)
         db.session.commit()
+        species_cache.invalidate()
 
-    def format(self):
-        return {
-          'id': self.id,
-          'name': self.name,
-          'description': self.description
-        }
+    # fields format() can return, all by default
+    FIELDS = ('id', 'name', 'description')
+
+    def format(self, fields=FIELDS):
+        return {field: getattr(self, field) for field in fields}
 
 
 '''
@@ -93,6 +355,12 @@ Model Animal
 
 class Animal(db.Model):
     __tablename__ = 'animals'
+    __table_args__ = (
+        # species joins and filters, also serves age per species
+        Index('ix_animals_species_id_age', 'species_id', 'age'),
+        # ordering and filtering by age
+        Index('ix_animals_age', 'age'),
+    )
 
     id = Column(Integer, primary_key=True)
     name = Column(String(40), unique=True, nullable=False)
@@ -108,24 +376,339 @@ class Animal(db.Model):
 
     def insert(self):
         db.session.add(self)
+        animal_version.bump()
         db.session.commit()
+        animal_counter.add(1)
+        species_stats.invalidate()
 
     def update(self):
+        animal_version.bump()
         db.session.commit()
+        species_stats.invalidate()
 
     def delete(self):
         db.session.delete(self)
+        animal_version.bump()
+        db.session.commit()
+        animal_counter.add(-1)
+        species_stats.invalidate()
+
+    @staticmethod
+    def insert_many(rows):
+        # one multi-row INSERT and one commit for a list of animal dicts
+        if not rows:
+            return
+        db.session.execute(Animal.__table__.insert().values(rows))
+        animal_version.bump()
+        db.session.commit()
+        animal_counter.add(len(rows))
+        species_stats.invalidate()
+
+    @staticmethod
+    def update_many(selection, values):
+        # one UPDATE and one commit for all animals of the selection, a
+        # query of Animal, returns the number of updated animals
+        updated = selection.update(values, synchronize_session=False)
+        animal_version.bump()
+        db.session.commit()
+        species_stats.invalidate()
+        return updated
+
+    @staticmethod
+    def delete_many(selection):
+        # one DELETE and one commit for all animals of the selection
+        deleted = selection.delete(synchronize_session=False)
+        animal_version.bump()
         db.session.commit()
+        animal_counter.add(-deleted)
+        species_stats.invalidate()
+        return deleted
+
+    # fields format() can return, all by default
+    FIELDS = ('id', 'name', 'species', 'age', 'comment', 'species_id')
+
+    @staticmethod
+    def columns(fields):
+        # the columns to load for the fields, used to narrow the SELECT
+        columns = {'species_id' if field == 'species' else field
+                   for field in fields}
+        columns.add('id')
+        return sorted(columns)
+
+    def format(self, fields=FIELDS):
+        return Animal.format_row(self, fields)
+
+    @staticmethod
+    def format_row(row, fields=FIELDS):
+        # formats an Animal or a row of its columns, only reads the
+        # requested fields so columns which were not loaded are not
+        # fetched one by one
+        formatted = {}
+        for field in fields:
+            if field == 'species':
+                formatted[field] = species_cache.get(row.species_id)
+            else:
+                formatted[field] = getattr(row, field)
+        return formatted
+
+
+# prefix search on the name (LIKE 'abc%'), PostgreSQL only uses an index
+# for it with the pattern operator class unless the database uses the C
+# collation
+event.listen(
+    Animal.__table__, 'after_create',
+    DDL('CREATE INDEX ix_animals_name_pattern ON animals '
+        '(name varchar_pattern_ops)').execute_if(dialect='postgresql'))
+
+# substring search on name and comment (ILIKE '%abc%') with trigram
+# indexes on PostgreSQL, SQLite scans the table with LIKE
+for statement in ('CREATE EXTENSION IF NOT EXISTS pg_trgm',
+                  'CREATE INDEX ix_animals_name_trgm ON animals '
+                  'USING gin (name gin_trgm_ops)',
+                  'CREATE INDEX ix_animals_comment_trgm ON animals '
+                  'USING gin (comment gin_trgm_ops)'):
+    event.listen(Animal.__table__, 'after_create',
+                 DDL(statement).execute_if(dialect='postgresql'))
 
-    def format(self):
-        return {
-          'id': self.id,
-          'name': self.name,
-          'species': self.species,
-          'age': self.age,
-          'comment': self.comment,
-          'species_id': self.species_id
-        }
+
+'''
+Model IdempotencyKey
+The responses of POST requests with an Idempotency-Key header when they
+are kept in the database, see idempotency.py
+'''
+
+
+class IdempotencyKey(db.Model):
+    __tablename__ = 'idempotency_keys'
+
+    # sha256 of the token subject, the route and the header
+    key = Column(String(64), primary_key=True)
+    # sha256 of the request body
+    fingerprint = Column(String(64), nullable=False)
+    # null while the first request is still running
+    status = Column(Integer)
+    mimetype = Column(String(100))
+    body = Column(LargeBinary)
+    # unix time, expired keys are deleted now and then
+    expires_at = Column(Integer, nullable=False, index=True)
+
+
+'''
+RowCounter
+Keeps the number of rows of a table in memory. The count is maintained
+by the insert and delete methods of the model and only read with
+COUNT(*) on first use or when it is older than the ttl.
+'''
+
+
+class RowCounter:
+    def __init__(self, column, ttl=ROW_COUNT_TTL):
+        self.column = column
+        self.ttl = ttl
+        self.value = None
+        self.counted_at = 0
+        self._lock = threading.Lock()
+
+    def get(self):
+        with self._lock:
+            expired = time.monotonic() - self.counted_at >= self.ttl
+            if self.value is None or expired:
+                self.value = db.session.query(func.count(self.column)).scalar()
+                self.counted_at = time.monotonic()
+            return self.value
+
+    def add(self, delta):
+        with self._lock:
+            if self.value is not None:
+                self.value += delta
+
+    def reset(self):
+        with self._lock:
+            self.value = None
+
+
+animal_counter = RowCounter(Animal.id)
+
+
+'''
+TableVersion
+The version of a table for ETags, a counter in the table_versions table.
+The write methods of the model bump it in the transaction of the write,
+so every worker sees the new version as soon as the write is committed.
+Reading it is a lookup by primary key.
+'''
+
+table_versions = db.Table(
+    'table_versions',
+    Column('name', String(50), primary_key=True),
+    Column('version', Integer, nullable=False))
+
+
+class TableVersion:
+    def __init__(self, name):
+        self.name = name
+        # a new database starts with the row in place, so the first
+        # writes of two workers don't both insert it
+        event.listen(table_versions, 'after_create', DDL(
+            "INSERT INTO table_versions (name, version) "
+            "VALUES ('{}', 0)".format(name)))
+
+    def bump(self):
+        # part of the transaction of the session, committed with the write
+        updated = db.session.execute(table_versions.update().where(
+            table_versions.c.name == self.name).values(
+                version=table_versions.c.version + 1)).rowcount
+        if not updated:
+            db.session.execute(table_versions.insert().values(
+                name=self.name, version=1))
+
+    def get(self):
+        version = db.session.execute(
+            select([table_versions.c.version]).where(
+                table_versions.c.name == self.name)).scalar()
+        return str(version or 0)
+
+
+animal_version = TableVersion('animals')
+
+
+'''
+SpeciesCache
+Read-through cache of the species catalogue, which almost never changes.
+Maps the species id to the formatted species. It is invalidated by the
+insert, update and delete methods of Species and read again after the
+ttl for the changes of other workers.
+'''
+
+
+class SpeciesCache:
+    def __init__(self, ttl=SPECIES_CACHE_TTL):
+        self.ttl = ttl
+        self.species = None
+        self.version = None
+        self.loaded_at = 0
+        self._lock = threading.Lock()
+
+    def get_all(self):
+        species = self.species
+        if species is not None and \
+                time.monotonic() - self.loaded_at < self.ttl:
+            return species
+
+        with self._lock:
+            if self.species is None or \
+                    time.monotonic() - self.loaded_at >= self.ttl:
+                self.species = {specie.id: specie.format() for specie in
+                                Species.query.order_by(Species.id)}
+                self.version = hashlib.sha1(json.dumps(
+                    self.species, sort_keys=True).encode()).hexdigest()
+                self.loaded_at = time.monotonic()
+            return self.species
+
+    def get_version(self):
+        # hash of the cached species, the same in every worker
+        self.get_all()
+        return self.version
+
+    def get(self, species_id):
+        if species_id is None:
+            return None
+        try:
+            return self.get_all().get(int(species_id))
+        except (TypeError, ValueError):
+            return None
+
+    def invalidate(self):
+        with self._lock:
+            self.species = None
+
+
+species_cache = SpeciesCache()
+
+
+'''
+SpeciesStats
+Number of animals and age distribution per species, computed with two
+GROUP BY queries and kept until a write through the Animal methods
+invalidates them or they are older than the ttl.
+'''
+
+
+class SpeciesStats:
+    def __init__(self, bucket_size=STATS_AGE_BUCKET_SIZE,
+                 ttl=STATS_CACHE_TTL):
+        self.bucket_size = int(bucket_size)
+        self.ttl = ttl
+        self.stats = None
+        self.loaded_at = 0
+        # counts the invalidations, so stats computed during a write
+        # are not kept
+        self.generation = 0
+        self._lock = threading.Lock()
+
+    def empty(self):
+        return {'count': 0, 'age': {'mean': None, 'min': None, 'max': None,
+                                    'histogram': []}}
+
+    def load(self):
+        stats = {}
+        for species_id, count, mean, youngest, oldest in db.session.query(
+                Animal.species_id, func.count(Animal.id), func.avg(Animal.age),
+                func.min(Animal.age), func.max(Animal.age)).group_by(
+                    Animal.species_id):
+            stats[species_id] = {'count': count, 'age': {
+                'mean': round(float(mean), 2) if mean is not None else None,
+                'min': youngest,
+                'max': oldest,
+                'histogram': []
+            }}
+
+        # the bucket size is inlined, the same expression with two bound
+        # parameters in SELECT and GROUP BY is rejected by PostgreSQL
+        bucket = (Animal.age - Animal.age % literal_column(
+            str(self.bucket_size))).label('bucket')
+        for species_id, start, count in db.session.query(
+                Animal.species_id, bucket, func.count(Animal.id)).group_by(
+                    Animal.species_id, bucket).order_by(
+                        Animal.species_id, bucket):
+            # the first animals of a species inserted after the first
+            # query show up in the next load
+            if species_id not in stats:
+                continue
+            stats[species_id]['age']['histogram'].append({
+                'from': start,
+                'to': start + self.bucket_size - 1,
+                'count': count
+            })
+        return stats
+
+    def get_all(self):
+        # species id -> statistics of the species with animals, the key
+        # None holds the animals without a species
+        stats = self.stats
+        if stats is not None and \
+                time.monotonic() - self.loaded_at < self.ttl:
+            return stats
+
+        with self._lock:
+            generation = self.generation
+        stats = self.load()
+        with self._lock:
+            if generation == self.generation:
+                self.stats = stats
+                self.loaded_at = time.monotonic()
+        return stats
+
+    def get(self, species_id):
+        return self.get_all().get(species_id) or self.empty()
+
+    def invalidate(self):
+        with self._lock:
+            self.generation += 1
+            self.stats = None
+
+
+species_stats = SpeciesStats()
 
 
 '''
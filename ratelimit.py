@@ -0,0 +1,104 @@
+import math
+import os
+import threading
+import time
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from flask import current_app, request
+from werkzeug.exceptions import TooManyRequests
+
+'''
+Rate limiting
+
+Every token gets a token bucket per permission and route: a request
+takes one token out, the bucket refills at the rate of the route up to
+its burst. A request on an empty bucket is answered with 429 and a
+Retry-After header. create_app sets the limits per route, the RATE_LIMITS
+setting overrides them.
+
+The buckets are kept in memory per worker. To share them between the
+workers, set RATE_LIMIT_STORE to a subclass of BucketStore, e.g. backed
+by Redis.
+'''
+
+# requests per second and burst of the routes without their own limit,
+# a rate of 0 turns the rate limiting off
+RATE_LIMIT = float(os.environ.get('RATE_LIMIT', 10))
+RATE_LIMIT_BURST = int(os.environ.get('RATE_LIMIT_BURST', 50))
+# seconds after which an unused bucket is dropped, a dropped bucket
+# starts full again, so keep it above burst / rate
+RATE_LIMIT_IDLE_TIMEOUT = int(os.environ.get('RATE_LIMIT_IDLE_TIMEOUT', 600))
+
+
+class BucketStore(ABC):
+    @abstractmethod
+    def take(self, key, rate, burst):
+        # takes a token from the bucket of key, returns 0 if there was
+        # one, else the seconds until there is one
+        pass
+
+
+class MemoryBucketStore(BucketStore):
+    def __init__(self, idle_timeout=RATE_LIMIT_IDLE_TIMEOUT):
+        self.idle_timeout = idle_timeout
+        # key -> (tokens, last use), ordered by the last use
+        self.buckets = OrderedDict()
+        self.limited = 0
+        self._lock = threading.Lock()
+
+    def take(self, key, rate, burst):
+        now = time.monotonic()
+        with self._lock:
+            bucket = self.buckets.pop(key, None)
+            if bucket is None:
+                tokens = burst
+            else:
+                tokens, used_at = bucket
+                tokens = min(burst, tokens + (now - used_at) * rate)
+
+            if tokens >= 1:
+                tokens -= 1
+                wait = 0
+            else:
+                wait = (1 - tokens) / rate
+                self.limited += 1
+            self.buckets[key] = (tokens, now)
+
+            # the oldest buckets come first, so dropping the idle ones
+            # stops at the first one in use
+            while self.buckets:
+                oldest = next(iter(self.buckets))
+                if now - self.buckets[oldest][1] <= self.idle_timeout:
+                    break
+                del self.buckets[oldest]
+        return wait
+
+    def stats(self):
+        with self._lock:
+            return {'buckets': len(self.buckets), 'limited': self.limited}
+
+
+def init_rate_limits(app, limits):
+    # limits maps endpoints to (requests per second, burst)
+    configured = dict(limits)
+    configured.update(app.config.get('RATE_LIMITS', {}))
+    app.config['RATE_LIMITS'] = configured
+    app.config.setdefault('RATE_LIMIT_DEFAULT', (RATE_LIMIT, RATE_LIMIT_BURST))
+    if app.config.get('RATE_LIMIT_STORE') is None:
+        app.config['RATE_LIMIT_STORE'] = MemoryBucketStore()
+
+
+def check_rate_limit(payload, permission):
+    # called by requires_auth once the token is verified
+    store = current_app.config.get('RATE_LIMIT_STORE')
+    if store is None:
+        return
+    rate, burst = current_app.config['RATE_LIMITS'].get(
+        request.endpoint, current_app.config['RATE_LIMIT_DEFAULT'])
+    if rate <= 0:
+        return
+
+    wait = store.take((payload.get('sub'), permission, request.endpoint),
+                      rate, burst)
+    if wait > 0:
+        raise TooManyRequests(retry_after=math.ceil(wait))
@@ -1,10 +1,39 @@
 import os
 import unittest
+import base64
+import gzip
 import json
+import shutil
+import subprocess
+import sys
+import threading
+import tempfile
+import time
+from unittest import mock
+from flask import Response
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import create_engine, event
+from sqlalchemy.engine.url import make_url
+from sqlalchemy.exc import DataError, OperationalError
 
 from app import create_app
-from models import setup_db, Animal, Species, db_drop_and_create_all
+from models import (
+    setup_db,
+    Animal,
+    Species,
+    db_drop_and_create_all,
+    db,
+    animal_counter,
+    species_cache,
+    species_stats,
+    slow_query_log,
+    engine_options
+    )
+from auth import JWKSCache, TokenCache
+from coalescing import SingleFlight
+from idempotency import DatabaseIdempotencyStore, MemoryIdempotencyStore
+from ratelimit import BucketStore, MemoryBucketStore
+from encoders import ENCODERS
 
 farm_guest_header = os.environ['GUEST']
 farm_manager_header = os.environ['MANAGER']
@@ -38,6 +67,7 @@ class FarmTestCase(unittest.TestCase):
             self.db.init_app(self.app)
             # create all tables
             self.db.create_all()
+            db.create_all()
             # db_drop_and_create_all
 
         # sample Animal for the tests
@@ -56,6 +86,25 @@ class FarmTestCase(unittest.TestCase):
         """Executed after reach test"""
         pass
 
+    def count_statements(self, request, app=None):
+        """Runs the request and returns the response and the number
+        of SQL statements it issued"""
+        statements = []
+
+        def before_cursor_execute(*args):
+            statements.append(args[2])
+
+        with (app or self.app).app_context():
+            engine = db.engine
+        event.listen(engine, 'before_cursor_execute', before_cursor_execute)
+        try:
+            res = request()
+        finally:
+            event.remove(engine, 'before_cursor_execute',
+                         before_cursor_execute)
+        self.statements = statements
+        return res, len(statements)
+
     # Test post request
     def test_post_animal(self):
         res = self.client().post('/animals', json=self.new_animal,
@@ -92,6 +141,510 @@ class FarmTestCase(unittest.TestCase):
         self.assertEqual(data['success'], True)
         self.assertTrue(data['animals'])
 
+    # Test get request with a page size
+    def test_get_animals_paginated(self):
+        res = self.client().get('/animals?page=1&per_page=1',
+                                headers={'Authorization': farm_guest_header})
+        data = json.loads(res.data)
+
+        # Check for success of the test
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(len(data['animals']), 1)
+        self.assertTrue(data['number'] >= 1)
+
+    # Test get request with a keyset cursor
+    def test_get_animals_cursor(self):
+        res = self.client().get('/animals?after=MA==&per_page=1',
+                                headers={'Authorization': farm_guest_header})
+        data = json.loads(res.data)
+
+        # Check for success of the test
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(len(data['animals']), 1)
+
+    # Test get request with an invalid cursor
+    def test_get_animals_cursor_error(self):
+        guest = {'Authorization': farm_guest_header}
+        # pages and ids beyond what the database can take
+        huge = base64.urlsafe_b64encode(str(10 ** 20).encode()).decode()
+        for query in ('page={}'.format(10 ** 20), 'after=' + huge,
+                      'after=dHJ1ZQ=='):
+            res = self.client().get('/animals?' + query, headers=guest)
+            self.assertEqual(res.status_code, 400)
+
+        res = self.client().get('/animals?after=nocursor', headers=guest)
+        data = json.loads(res.data)
+
+        # Check for success of the test
+        self.assertEqual(res.status_code, 400)
+        self.assertFalse(data['success'])
+
+    # Test the start page with the animal of the day
+    def test_start(self):
+        # the species come from the cache, which other tests may have
+        # emptied
+        with self.app.app_context():
+            species_cache.get_all()
+        res, statements = self.count_statements(
+            lambda: self.client().get('/'))
+        data = json.loads(res.data)
+
+        # Check for success of the test
+        self.assertEqual(res.status_code, 200)
+        self.assertTrue('Animal' in data or 'message' in data)
+        self.assertLessEqual(statements, 1)
+
+    # Test that single row operations don't load the whole table
+    def test_statement_counts(self):
+        manager = {'Authorization': farm_manager_header}
+        # first request reads the count of animals
+        self.client().get('/animals', headers=manager)
+        with self.app.app_context():
+            species_cache.get_all()
+
+        res, statements = self.count_statements(
+            lambda: self.client().get('/animals', headers=manager))
+        self.assertEqual(res.status_code, 200)
+        self.assertLessEqual(statements, 2)
+
+        res, statements = self.count_statements(
+            lambda: self.client().get('/animals/2', headers=manager))
+        self.assertEqual(res.status_code, 200)
+        self.assertLessEqual(statements, 2)
+
+        new_animal = dict(self.new_animal, name='Counted')
+        res, statements = self.count_statements(
+            lambda: self.client().post('/animals', json=new_animal,
+                                       headers=manager))
+        self.assertEqual(res.status_code, 200)
+        self.assertLessEqual(statements, 3)
+
+        animal_id = json.loads(res.data)['created']
+        res, statements = self.count_statements(
+            lambda: self.client().delete('/animals/' + str(animal_id),
+                                         headers=manager))
+        self.assertEqual(res.status_code, 200)
+        # the lookup, the DELETE and the bump of the table version
+        self.assertLessEqual(statements, 3)
+
+    # Test that the species of a page are not loaded one by one
+    def test_get_animals_details_statements(self):
+        with self.app.app_context():
+            animals = [Animal(name='Page animal ' + str(i), age=i,
+                              comment='', species_id=1)
+                       for i in range(100)]
+            db.session.add_all(animals)
+            db.session.commit()
+            animal_counter.get()
+            species_cache.get_all()
+
+        try:
+            res, small_page = self.count_statements(
+                lambda: self.client().get(
+                    '/animals?details=true&per_page=1',
+                    headers={'Authorization': farm_guest_header}))
+            res, large_page = self.count_statements(
+                lambda: self.client().get(
+                    '/animals?details=true&per_page=100',
+                    headers={'Authorization': farm_guest_header}))
+            data = json.loads(res.data)
+
+            # Check for success of the test
+            self.assertEqual(res.status_code, 200)
+            self.assertEqual(len(data['animals']), 100)
+            self.assertTrue(data['animals'][0]['species'])
+            self.assertEqual(small_page, large_page)
+        finally:
+            with self.app.app_context():
+                Animal.query.filter(
+                    Animal.name.like('Page animal %')).delete(
+                    synchronize_session=False)
+                db.session.commit()
+                animal_counter.reset()
+
+    # Test conditional get requests with an ETag
+    def test_get_animals_etag(self):
+        manager = {'Authorization': farm_manager_header}
+        res = self.client().get('/animals', headers=manager)
+        etag = res.headers['ETag']
+
+        res, statements = self.count_statements(
+            lambda: self.client().get('/animals', headers=dict(
+                manager, **{'If-None-Match': etag})))
+        self.assertEqual(res.status_code, 304)
+        self.assertEqual(res.data, b'')
+        self.assertEqual(statements, 1)
+
+        # a write changes the ETag
+        self.client().patch('/animals/2', json={'age': 4}, headers=manager)
+        res = self.client().get('/animals', headers=dict(
+            manager, **{'If-None-Match': etag}))
+        self.assertEqual(res.status_code, 200)
+        self.assertNotEqual(res.headers['ETag'], etag)
+
+        res = self.client().get('/species', headers=manager)
+        res = self.client().get('/species', headers=dict(
+            manager, **{'If-None-Match': res.headers['ETag']}))
+        self.assertEqual(res.status_code, 304)
+
+    # Test that renaming a species changes the ETags of the animal reads
+    # that show it, and only of those
+    def test_get_animals_etag_species(self):
+        manager = {'Authorization': farm_manager_header}
+        urls = {'/animals/2': True, '/animals?details=true': True,
+                '/animals?fields=id,species': True, '/animals': False,
+                '/animals/2?fields=age': False}
+        etags = {url: self.client().get(url, headers=manager).headers['ETag']
+                 for url in urls}
+
+        with self.app.app_context():
+            species = Species.query.get(Animal.query.get(2).species_id)
+            name = species.name
+            species.name = 'Renamed'
+            species.update()
+        try:
+            for url, shows_species in urls.items():
+                res = self.client().get(url, headers=dict(
+                    manager, **{'If-None-Match': etags[url]}))
+                self.assertEqual(res.status_code,
+                                 200 if shows_species else 304, url)
+        finally:
+            with self.app.app_context():
+                species = Species.query.filter(
+                    Species.name == 'Renamed').one()
+                species.name = name
+                species.update()
+
+    # Test that concurrent identical requests run the queries once
+    def test_get_animals_coalesced(self):
+        guest = {'Authorization': farm_guest_header}
+        url = '/animals?per_page=5'
+        res, single = self.count_statements(
+            lambda: self.client().get(url, headers=guest))
+
+        # slows down the page query so all requests arrive while it runs
+        pages = []
+
+        def slow_page(conn, cursor, statement, *args):
+            if 'FROM animals' in statement and 'LIMIT' in statement:
+                pages.append(statement)
+                time.sleep(0.2)
+
+        with self.app.app_context():
+            engine = db.engine
+        barrier = threading.Barrier(8)
+        responses = []
+
+        def get():
+            client = self.app.test_client()
+            barrier.wait()
+            responses.append(client.get(url, headers=guest))
+
+        def get_concurrently():
+            threads = [threading.Thread(target=get) for number in range(8)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+
+        event.listen(engine, 'before_cursor_execute', slow_page)
+        try:
+            res, statements = self.count_statements(get_concurrently)
+        finally:
+            event.remove(engine, 'before_cursor_execute', slow_page)
+
+        self.assertEqual(len(pages), 1)
+        self.assertEqual(statements, single)
+        self.assertEqual(len(responses), 8)
+        for res in responses:
+            self.assertEqual(res.status_code, 200)
+            self.assertEqual(res.data, responses[0].data)
+
+    # Test coalescing when the first request takes too long
+    def test_get_animals_coalesced_error(self):
+        flight = SingleFlight(timeout=0.05)
+        started = threading.Event()
+        release = threading.Event()
+
+        def slow():
+            started.set()
+            release.wait()
+            return 'first'
+
+        leader = threading.Thread(target=flight.do, args=('key', slow))
+        leader.start()
+        started.wait()
+        try:
+            # the waiting request gives up and runs on its own
+            self.assertEqual(flight.do('key', lambda: 'own'), 'own')
+            self.assertEqual(flight.stats()['timeouts'], 1)
+        finally:
+            release.set()
+            leader.join()
+        self.assertEqual(flight.stats()['in_flight'], 0)
+
+        # a failing request is not shared, the error is raised
+        with self.assertRaises(ValueError):
+            flight.do('key', lambda: int('x'))
+        self.assertEqual(flight.stats()['in_flight'], 0)
+
+    # Test the species statistics and their cache
+    def test_get_species_stats(self):
+        guest = {'Authorization': farm_guest_header}
+        with self.app.app_context():
+            species = Species(name='Stats species', description='')
+            species.insert()
+            species_id = species.id
+            Animal.insert_many([
+                {'name': 'Stats ' + str(age), 'age': age, 'comment': '',
+                 'species_id': species_id} for age in (1, 3, 7)])
+        try:
+            res = self.client().get('/species/stats', headers=guest)
+            data = json.loads(res.data)
+            self.assertEqual(res.status_code, 200)
+            entry = [entry for entry in data['species']
+                     if entry['id'] == species_id][0]
+            self.assertEqual(entry['count'], 3)
+            self.assertEqual(entry['age']['min'], 1)
+            self.assertEqual(entry['age']['max'], 7)
+            self.assertAlmostEqual(entry['age']['mean'], 3.67)
+            self.assertEqual(entry['age']['histogram'], [
+                {'from': 0, 'to': 4, 'count': 2},
+                {'from': 5, 'to': 9, 'count': 1}])
+
+            # served from the cache until an animal changes
+            res, statements = self.count_statements(
+                lambda: self.client().get('/species/{}/stats'.format(
+                    species_id), headers=guest))
+            self.assertEqual(statements, 0)
+            self.assertEqual(json.loads(res.data)['species'], entry)
+
+            self.client().patch('/animals?species_id={}'.format(species_id),
+                                json={'age_increment': 10}, headers={
+                                    'Authorization': farm_manager_header})
+            res = self.client().get('/species/{}/stats'.format(species_id),
+                                    headers=guest)
+            data = json.loads(res.data)
+            self.assertEqual(data['species']['age']['min'], 11)
+        finally:
+            with self.app.app_context():
+                Animal.delete_many(Animal.query.filter(
+                    Animal.species_id == species_id))
+                Species.query.get(species_id).delete()
+
+    # Test that an animal inserted between the two statistics queries
+    # doesn't break them
+    def test_species_stats_concurrent_insert(self):
+        engine = create_engine(self.DB_PATH)
+        inserted = []
+
+        def insert(conn, cursor, statement, *args):
+            # right before the histogram query
+            if 'bucket' in statement and not inserted:
+                inserted.append(engine.execute(
+                    Animal.__table__.insert().values(
+                        name='Stats race', age=1, comment='race',
+                        species_id=species_id)))
+
+        with self.app.app_context():
+            species = Species(name='Race species', description='')
+            species.insert()
+            species_id = species.id
+            event.listen(db.engine, 'before_cursor_execute', insert)
+            try:
+                stats = species_stats.load()
+            finally:
+                event.remove(db.engine, 'before_cursor_execute', insert)
+                engine.execute(Animal.__table__.delete().where(
+                    Animal.comment == 'race'))
+                Species.query.get(species_id).delete()
+
+        # Check for success of the test
+        self.assertTrue(inserted)
+        self.assertNotIn(species_id, stats)
+
+    # Test species statistics error
+    def test_get_species_stats_error(self):
+        res = self.client().get('/species/999/stats',
+                                headers={'Authorization': farm_guest_header})
+        data = json.loads(res.data)
+
+        # Check for success of the test
+        self.assertEqual(res.status_code, 404)
+        self.assertFalse(data['success'])
+
+    # Test the rate limit per token and route
+    def test_rate_limit(self):
+        app = create_app({'RATE_LIMITS': {'get_species': (1, 2)}})
+        manager = {'Authorization': farm_manager_header}
+        for request in range(2):
+            res = app.test_client().get('/species', headers=manager)
+            self.assertEqual(res.status_code, 200)
+
+        res = app.test_client().get('/species', headers=manager)
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 429)
+        self.assertEqual(res.headers['Retry-After'], '1')
+        self.assertFalse(data['success'])
+
+        # other tokens and routes have their own buckets
+        res = app.test_client().get('/species', headers={
+            'Authorization': farm_guest_header})
+        self.assertEqual(res.status_code, 200)
+        res = app.test_client().get('/animals', headers=manager)
+        self.assertEqual(res.status_code, 200)
+
+    # Test rate limit with a shared store and the eviction of idle buckets
+    def test_rate_limit_error(self):
+        class EmptyStore(BucketStore):
+            def take(self, key, rate, burst):
+                self.key = key
+                return 2.5
+
+        store = EmptyStore()
+        app = create_app({'RATE_LIMIT_STORE': store})
+        res = app.test_client().post('/animals', json=self.new_animal,
+                                     headers={
+                                         'Authorization': farm_manager_header
+                                         })
+
+        # Check for success of the test
+        self.assertEqual(res.status_code, 429)
+        self.assertEqual(res.headers['Retry-After'], '3')
+        self.assertEqual(store.key[1:], ('post:animals', 'post_animal'))
+
+        # a store without take() fails when it is created
+        class IncompleteStore(BucketStore):
+            pass
+
+        with self.assertRaises(TypeError):
+            IncompleteStore()
+
+        store = MemoryBucketStore(idle_timeout=0)
+        self.assertEqual(store.take('first', 1, 1), 0)
+        self.assertGreater(store.take('first', 1, 1), 0)
+        time.sleep(0.01)
+        store.take('second', 1, 1)
+        self.assertEqual(list(store.buckets), ['second'])
+
+    # Test that a write in another worker changes the ETag
+    def test_get_animals_etag_other_worker(self):
+        manager = {'Authorization': farm_manager_header}
+        res = self.client().get('/animals/2', headers=manager)
+        etag = res.headers['ETag']
+
+        # an update, which changes neither the largest id nor the count
+        subprocess.run([sys.executable, '-c', (
+            'import app, models\n'
+            'with app.create_app().app_context():\n'
+            '    animal = models.Animal.query.get(2)\n'
+            '    animal.age = animal.age + 1\n'
+            '    animal.update()\n')], check=True)
+
+        res = self.client().get('/animals/2', headers=dict(
+            manager, **{'If-None-Match': etag}))
+        self.assertEqual(res.status_code, 200)
+        self.assertNotEqual(res.headers['ETag'], etag)
+
+    # Test filters, sorting and search of the animals
+    def test_get_animals_filtered(self):
+        guest = {'Authorization': farm_guest_header}
+        res = self.client().get('/animals?details=true&species_id=3'
+                                '&min_age=1&max_age=20', headers=guest)
+        data = json.loads(res.data)
+
+        # Check for success of the test
+        self.assertEqual(res.status_code, 200)
+        self.assertTrue(data['animals'])
+        for animal in data['animals']:
+            self.assertEqual(animal['species_id'], 3)
+            self.assertTrue(1 <= animal['age'] <= 20)
+        with self.app.app_context():
+            self.assertEqual(data['number'], Animal.query.filter(
+                Animal.species_id == 3, Animal.age.between(1, 20)).count())
+
+        res = self.client().get('/animals?details=true&sort=-age',
+                                headers=guest)
+        ages = [animal['age'] for animal in json.loads(res.data)['animals']]
+        self.assertEqual(ages, sorted(ages, reverse=True))
+
+        res = self.client().get('/animals?q=sHA', headers=guest)
+        data = json.loads(res.data)
+        self.assertIn('Shao', data['animals'].values())
+        self.assertEqual(data['number'], len(data['animals']))
+
+    # Test sparse fieldsets, only the requested columns are selected
+    def test_get_animals_fields(self):
+        guest = {'Authorization': farm_guest_header}
+        res, statements = self.count_statements(
+            lambda: self.client().get('/animals?fields=id,name',
+                                      headers=guest))
+        data = json.loads(res.data)
+
+        # Check for success of the test
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(set(data['animals'][0]), {'id', 'name'})
+        self.assertFalse([statement for statement in self.statements
+                          if 'animals.comment' in statement])
+
+        res = self.client().get('/animals/2?fields=age', headers=guest)
+        data = json.loads(res.data)
+        self.assertEqual(list(data['animal']), ['age'])
+
+        res = self.client().get('/species?fields=name', headers=guest)
+        data = json.loads(res.data)
+        self.assertEqual(list(data['species'][0]), ['name'])
+
+    # Test sparse fieldsets error
+    def test_get_animals_fields_error(self):
+        res = self.client().get('/animals?fields=id,weight',
+                                headers={'Authorization': farm_guest_header})
+        data = json.loads(res.data)
+
+        # Check for success of the test
+        self.assertEqual(res.status_code, 400)
+        self.assertFalse(data['success'])
+
+    # Test filter error
+    def test_get_animals_filtered_error(self):
+        guest = {'Authorization': farm_guest_header}
+        # filters that don't fit into the integer columns
+        for name in ('species_id', 'min_age', 'max_age'):
+            res = self.client().get('/animals?{}={}'.format(name, 10 ** 20),
+                                    headers=guest)
+            self.assertEqual(res.status_code, 400)
+        # cursors with a bool instead of the id or the age
+        for sort, cursor in (('name', ['a', True]), ('age', [True, 1]),
+                             ('age', [1, 10 ** 20])):
+            after = base64.urlsafe_b64encode(
+                json.dumps(cursor).encode()).decode()
+            res = self.client().get('/animals?sort={}&after={}'.format(
+                sort, after), headers=guest)
+            self.assertEqual(res.status_code, 400)
+
+        res = self.client().get('/animals?sort=weight', headers=guest)
+        data = json.loads(res.data)
+
+        # Check for success of the test
+        self.assertEqual(res.status_code, 400)
+        self.assertFalse(data['success'])
+
+    # Test that every response encoder returns the same animals
+    def test_get_animals_encoders(self):
+        responses = []
+        for encoder in ENCODERS:
+            app = create_app({'RESPONSE_ENCODER': encoder})
+            res = app.test_client().get('/animals?fields=id,name,species',
+                                        headers={
+                                            'Authorization': farm_guest_header
+                                            })
+            self.assertEqual(res.status_code, 200)
+            responses.append(json.loads(res.data))
+
+        # Check for success of the test
+        for data in responses:
+            self.assertEqual(data, responses[0])
+
     # Test get request for auth error
     def test_get_animals_error(self):
         res = self.client().get('/animals')
@@ -112,6 +665,95 @@ class FarmTestCase(unittest.TestCase):
         self.assertEqual(data['success'], True)
         self.assertTrue(data['species'])
 
+    # Test that the species come from the cache and writes invalidate it
+    def test_get_species_cached(self):
+        guest = {'Authorization': farm_guest_header}
+        self.client().get('/species', headers=guest)
+
+        res, statements = self.count_statements(
+            lambda: self.client().get('/species', headers=guest))
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(statements, 0)
+
+        with self.app.app_context():
+            species = Species(name='Cached species', description='')
+            species.insert()
+            species_id = species.id
+        try:
+            res = self.client().get('/species', headers=guest)
+            data = json.loads(res.data)
+            self.assertEqual(data['species'][str(species_id)],
+                             'Cached species')
+        finally:
+            with self.app.app_context():
+                Species.query.get(species_id).delete()
+
+        res = self.client().get('/species', headers=guest)
+        data = json.loads(res.data)
+        self.assertNotIn(str(species_id), data['species'])
+
+    # Test the metrics in the Prometheus text format
+    def test_get_metrics(self):
+        self.client().get('/species',
+                          headers={'Authorization': farm_guest_header})
+        res = self.client().get('/metrics')
+        text = res.data.decode()
+
+        # Check for success of the test
+        self.assertEqual(res.status_code, 200)
+        self.assertIn('farm_request_duration_seconds_count{route="/species",'
+                      'method="GET"}', text)
+        self.assertIn('farm_responses_total{route="/species",method="GET",'
+                      'status="200"}', text)
+        self.assertIn('farm_sql_statements_total', text)
+        self.assertIn('farm_jwt_verify_seconds_count', text)
+
+    # Test gzip compression of large responses and of the export
+    def test_get_species_compressed(self):
+        headers = {'Authorization': farm_guest_header,
+                   'Accept-Encoding': 'gzip'}
+        res = self.client().get('/species?fields=id,description',
+                                headers=headers)
+        data = json.loads(gzip.decompress(res.data))
+
+        # Check for success of the test
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.headers['Content-Encoding'], 'gzip')
+        self.assertTrue(res.headers['ETag'].endswith('-gzip"'))
+        self.assertTrue(data['species'])
+
+        res = self.client().get('/species?fields=id,description',
+                                headers=dict(headers, **{
+                                    'If-None-Match': res.headers['ETag']}))
+        self.assertEqual(res.status_code, 304)
+
+        res = self.client().get('/animals/export', headers=headers)
+        lines = gzip.decompress(res.data).decode().splitlines()
+        self.assertEqual(res.headers['Content-Encoding'], 'gzip')
+        self.assertTrue(json.loads(lines[0])['name'])
+
+    # Test that a compressed response follows a change of the content
+    # the table version doesn't see
+    def test_get_animals_compressed_changed(self):
+        headers = {'Authorization': farm_guest_header,
+                   'Accept-Encoding': 'gzip'}
+
+        def ages():
+            res = self.client().get('/animals?details=true&per_page=100',
+                                    headers=headers)
+            self.assertEqual(res.headers['Content-Encoding'], 'gzip')
+            return [animal['age'] for animal in
+                    json.loads(gzip.decompress(res.data))['animals']]
+
+        before = ages()
+        engine = create_engine(self.DB_PATH)
+        engine.execute('UPDATE animals SET age = age + 100')
+        try:
+            self.assertEqual(ages(), [age + 100 for age in before])
+        finally:
+            engine.execute('UPDATE animals SET age = age - 100')
+            engine.dispose()
+
     # Test get request for species error
     def test_get_species_error(self):
         res = self.client().get('/species')
@@ -121,6 +763,157 @@ class FarmTestCase(unittest.TestCase):
         self.assertEqual(res.status_code, 500)
         self.assertFalse(data['success'])
 
+    # Test export of the animals as NDJSON and CSV
+    def test_export_animals(self):
+        res = self.client().get('/animals/export?format=ndjson',
+                                headers={'Authorization': farm_guest_header})
+        lines = res.data.decode().splitlines()
+
+        # Check for success of the test
+        self.assertEqual(res.status_code, 200)
+        self.assertTrue(lines)
+        self.assertTrue(json.loads(lines[0])['name'])
+
+        res = self.client().get('/animals/export?format=csv',
+                                headers={'Authorization': farm_guest_header})
+        lines = res.data.decode().splitlines()
+
+        # Check for success of the test
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(lines[0], 'id,name,age,comment,species_id')
+        self.assertEqual(len(lines) - 1, len(
+            self.client().get('/animals/export',
+                              headers={
+                                  'Authorization': farm_guest_header
+                                  }).data.decode().splitlines()))
+
+    # Test export error
+    def test_export_animals_error(self):
+        res = self.client().get('/animals/export?format=xml',
+                                headers={'Authorization': farm_guest_header})
+        data = json.loads(res.data)
+
+        # Check for success of the test
+        self.assertEqual(res.status_code, 400)
+        self.assertFalse(data['success'])
+
+    # Test the slow query log with a threshold every statement exceeds
+    def test_get_slow_queries(self):
+        with self.app.app_context():
+            slow_query_log.attach(db.engine)
+        slow_query_log.configure(0, True)
+        try:
+            self.client().get('/animals/2',
+                              headers={'Authorization': farm_guest_header})
+        finally:
+            slow_query_log.configure(None, False)
+
+        res = self.client().get('/admin/slow-queries',
+                                headers={
+                                    'Authorization': farm_manager_header
+                                    })
+        data = json.loads(res.data)
+        entries = [entry for entry in data['slow_queries']
+                   if entry['call_site'].startswith('app.py')]
+
+        # Check for success of the test
+        self.assertEqual(res.status_code, 200)
+        self.assertTrue(entries)
+        self.assertEqual(entries[-1]['route'], '/animals/<int:animal_id>')
+        self.assertTrue(entries[-1]['plan'])
+
+    # Test slow query log for auth error
+    def test_get_slow_queries_error(self):
+        res = self.client().get('/admin/slow-queries',
+                                headers={'Authorization': farm_guest_header})
+
+        # Check for success of the test
+        self.assertEqual(res.status_code, 401)
+
+    # Test the health check with the pool status
+    def test_health(self):
+        res = self.client().get('/health')
+        data = json.loads(res.data)
+
+        # Check for success of the test
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['database'], 'ok')
+        self.assertGreaterEqual(data['latency_ms'], 0)
+        self.assertIn('checkedout', data['pool'])
+        self.assertIn('overflow', data['pool'])
+
+    # Test health check for an unreachable database
+    def test_health_error(self):
+        with self.app.app_context():
+            with mock.patch.object(db.engine, 'connect', side_effect=(
+                    OperationalError('SELECT 1', {}, Exception('down')))):
+                res = self.client().get('/health')
+        data = json.loads(res.data)
+
+        # Check for success of the test
+        self.assertEqual(res.status_code, 503)
+        self.assertFalse(data['success'])
+
+    # Test that GET requests read from a replica, writes from the primary
+    def test_read_replica(self):
+        replica = os.path.join(tempfile.mkdtemp(), 'replica.db')
+        shutil.copyfile(make_url(self.DB_PATH).database, replica)
+        # a change that only the replica has
+        engine = create_engine('sqlite:///' + replica)
+        engine.execute("UPDATE animals SET name = 'Replica' WHERE id = 2")
+        app = create_app({'DATABASE_REPLICA_URLS': ['sqlite:///' + replica]})
+        manager = {'Authorization': farm_manager_header}
+
+        res = app.test_client().get('/animals/2', headers=manager)
+        self.assertEqual(json.loads(res.data)['Name'], 'Replica')
+
+        res = app.test_client().patch('/animals/2', json={'age': 14},
+                                      headers=manager)
+        self.assertEqual(res.status_code, 200)
+        with app.app_context():
+            self.assertEqual(Animal.query.get(2).age, 14)
+        age = engine.execute('SELECT age FROM animals WHERE id = 2').scalar()
+        self.assertNotEqual(age, 14)
+        engine.dispose()
+
+        # a read after a write in the same request sees the primary
+        with app.test_request_context('/animals/2'):
+            name = db.session.query(Animal.name).filter_by(id=2)
+            self.assertEqual(name.scalar(), 'Replica')
+            db.session.execute(Animal.__table__.update().where(
+                Animal.id == 2).values(age=5))
+            self.assertNotEqual(name.scalar(), 'Replica')
+            db.session.rollback()
+
+    # Test that creating the app leaves the schema to the create_db command
+    def test_create_app_without_schema(self):
+        path = os.path.join(tempfile.mkdtemp(), 'empty.db')
+        app = create_app()
+        setup_db(app, 'sqlite:///' + path)
+        with app.app_context():
+            self.assertEqual(db.engine.table_names(), [])
+            db.create_all()
+            self.assertIn('animals', db.engine.table_names())
+
+    # Test that jose is only imported once a token is verified
+    def test_lazy_imports(self):
+        output = subprocess.run(
+            [sys.executable, '-c', 'import sys, app; app.create_app(); '
+             'print("jose" in sys.modules)'],
+            check=True, capture_output=True, text=True).stdout
+        self.assertEqual(output.strip(), 'False')
+
+    # Test the engine options per database
+    def test_engine_options(self):
+        options = engine_options('postgres://farm@localhost/farm',
+                                 pool_size=2, statement_timeout=5000)
+        self.assertEqual(options['pool_size'], 2)
+        self.assertEqual(options['connect_args']['options'],
+                         '-c statement_timeout=5000')
+        # SQLite has no pool to size
+        self.assertEqual(engine_options('sqlite:///farm.db'),
+                         {'pool_pre_ping': True})
+
     # Test get request for animals id
     def test_get_animals_via_id(self):
         res = self.client().get('/animals/2',
@@ -142,6 +935,265 @@ class FarmTestCase(unittest.TestCase):
         self.assertEqual(res.status_code, 404)
         self.assertFalse(data['success'])
 
+    # Test that a retried post request with the same Idempotency-Key is
+    # answered with the first response, with both stores
+    def test_post_animal_idempotent(self):
+        for store in ('memory', 'database'):
+            app = create_app({'IDEMPOTENCY_STORE': store})
+            headers = {'Authorization': farm_manager_header,
+                       'Idempotency-Key': 'retry-' + store}
+            animal = dict(self.new_animal, name='Retry ' + store)
+            try:
+                res = app.test_client().post('/animals', json=animal,
+                                             headers=headers)
+                self.assertEqual(res.status_code, 200)
+                first = json.loads(res.data)
+
+                res, statements = self.count_statements(
+                    lambda: app.test_client().post(
+                        '/animals', json=animal, headers=headers), app)
+                self.assertEqual(res.status_code, 200)
+                self.assertEqual(json.loads(res.data), first)
+                self.assertEqual(res.headers['Idempotent-Replayed'], 'true')
+                self.assertFalse(any('animals' in statement
+                                     for statement in self.statements))
+                # the database store tries to insert the key and reads
+                # the stored response
+                self.assertEqual(statements, 2 if store == 'database' else 0)
+            finally:
+                with app.app_context():
+                    Animal.query.filter(
+                        Animal.name == animal['name']).delete()
+                    db.session.commit()
+                    animal_counter.reset()
+
+    # Test that a key is only held for the lease while its request runs
+    # and for the ttl once the response is stored, with both stores
+    def test_idempotency_lease(self):
+        for store in (MemoryIdempotencyStore(ttl=3600, lease=0),
+                      DatabaseIdempotencyStore(ttl=3600, lease=0)):
+            with self.app.app_context():
+                # the worker holding the key died before saving
+                self.assertIsNone(store.reserve('crashed', 'body'))
+                self.assertIsNone(store.reserve('crashed', 'body'))
+
+                store.save('crashed', Response('saved', status=200))
+                entry = store.reserve('crashed', 'body')
+                self.assertEqual(entry['status'], 200)
+                store.release('crashed')
+
+    # Test Idempotency-Key reused with another body
+    def test_post_animal_idempotent_error(self):
+        headers = {'Authorization': farm_manager_header,
+                   'Idempotency-Key': 'reused'}
+        res = self.client().post('/animals', json=self.new_wrong_animal,
+                                 headers=headers)
+        self.assertEqual(res.status_code, 400)
+        # failed requests are not stored, the key is free again
+        res = self.client().post('/animals', json={'name': 'Other'},
+                                 headers=headers)
+        self.assertEqual(res.status_code, 400)
+
+        # a key whose first request is still running
+        store = self.app.config['IDEMPOTENCY_STORE']
+        self.assertIsNone(store.reserve('running', 'body'))
+        self.assertIsNone(store.reserve('running', 'body')['status'])
+
+        animal = dict(self.new_animal, name='Reused key')
+        try:
+            res = self.client().post('/animals', json=animal,
+                                     headers=headers)
+            self.assertEqual(res.status_code, 200)
+            res = self.client().post('/animals', json=dict(animal, age=1),
+                                     headers=headers)
+            data = json.loads(res.data)
+        finally:
+            with self.app.app_context():
+                Animal.query.filter(Animal.name == 'Reused key').delete()
+                db.session.commit()
+                animal_counter.reset()
+
+        # Check for success of the test
+        self.assertEqual(res.status_code, 422)
+        self.assertFalse(data['success'])
+
+    # Test bulk post request with a JSON array and a NDJSON stream
+    def test_post_animals_bulk(self):
+        rows = [dict(self.new_animal, name='Bulk animal ' + str(i))
+                for i in range(5)]
+        # a duplicate and an incomplete row are reported per row
+        rows.append(dict(self.new_animal, name='Bulk animal 0'))
+        rows.append(self.new_wrong_animal)
+        ndjson = '\n'.join(json.dumps(dict(self.new_animal,
+                                           name='Bulk animal ' + str(i)))
+                           for i in range(5, 8))
+
+        try:
+            res = self.client().post('/animals/bulk?chunk_size=2',
+                                     json=rows,
+                                     headers={
+                                         'Authorization': farm_manager_header
+                                         })
+            data = json.loads(res.data)
+
+            # Check for success of the test
+            self.assertEqual(res.status_code, 200)
+            self.assertEqual(data['inserted'], 5)
+            self.assertEqual([error['row'] for error in data['errors']],
+                             [5, 6])
+
+            res = self.client().post('/animals/bulk', data=ndjson,
+                                     content_type='application/x-ndjson',
+                                     headers={
+                                         'Authorization': farm_manager_header
+                                         })
+            data = json.loads(res.data)
+
+            # Check for success of the test
+            self.assertEqual(res.status_code, 200)
+            self.assertEqual(data['inserted'], 3)
+            self.assertEqual(data['errors'], [])
+        finally:
+            with self.app.app_context():
+                Animal.query.filter(
+                    Animal.name.like('Bulk animal %')).delete(
+                    synchronize_session=False)
+                db.session.commit()
+                animal_counter.reset()
+
+    # Test bulk post request error
+    def test_post_animals_bulk_error(self):
+        res = self.client().post('/animals/bulk', json=self.new_wrong_animal,
+                                 headers={
+                                     'Authorization': farm_manager_header
+                                     })
+        data = json.loads(res.data)
+
+        # Check for success of the test
+        self.assertEqual(res.status_code, 400)
+        self.assertFalse(data['success'])
+
+    # Test bulk post request with rows of the wrong types and lengths
+    def test_post_animals_bulk_invalid_rows(self):
+        manager = {'Authorization': farm_manager_header}
+        row = {'name': 'Invalid', 'age': 1, 'comment': '', 'species_id': 1}
+        res = self.client().post('/animals/bulk', json=[
+            dict(row, name=['x']),
+            dict(row, comment={'a': 1}),
+            dict(row, name='x' * 41),
+            dict(row, age=10 ** 12)
+        ], headers=manager)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['inserted'], 0)
+        self.assertEqual([error['errors'] for error in data['errors']], [
+            ['name must be a string'], ['comment must be a string'],
+            ['name is longer than 40 characters'], ['age is out of range']])
+
+        # a row the database refuses doesn't stop the others
+        refused = DataError('INSERT', {}, Exception('value too long'))
+        with mock.patch.object(Animal, 'insert_many',
+                               side_effect=[refused, None, refused]):
+            res = self.client().post('/animals/bulk', json=[
+                dict(row, name='Invalid 1'), dict(row, name='Invalid 2')],
+                headers=manager)
+        data = json.loads(res.data)
+
+        # Check for success of the test
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['inserted'], 1)
+        self.assertEqual(data['errors'], [
+            {'row': 1, 'errors': ['value too long']}])
+
+    # Test batch patch and delete requests by ids and by filter
+    def test_patch_and_delete_animals_batch(self):
+        manager = {'Authorization': farm_manager_header}
+        with self.app.app_context():
+            Animal.insert_many([
+                {'name': 'Batch ' + str(number), 'age': number,
+                 'comment': 'batch', 'species_id': 1}
+                for number in range(4)])
+            ids = [animal.id for animal in
+                   Animal.query.filter(Animal.comment == 'batch')]
+        try:
+            res, statements = self.count_statements(
+                lambda: self.client().patch(
+                    '/animals?species_id=1&q=Batch',
+                    json={'age_increment': 1}, headers=manager))
+            data = json.loads(res.data)
+            self.assertEqual(res.status_code, 200)
+            self.assertEqual(data['updated'], 4)
+            # a single UPDATE and the bump of the table version, no row
+            # by row round trips
+            self.assertEqual(statements, 2)
+
+            res = self.client().patch('/animals', json={
+                'ids': ids[:2], 'age': 10}, headers=manager)
+            self.assertEqual(json.loads(res.data)['updated'], 2)
+            with self.app.app_context():
+                ages = [Animal.query.get(animal_id).age
+                        for animal_id in ids]
+            self.assertEqual(ages, [10, 10, 3, 4])
+
+            res = self.client().delete('/animals', json={'ids': ids[:3]},
+                                       headers=manager)
+            data = json.loads(res.data)
+            self.assertEqual(res.status_code, 200)
+            self.assertEqual(data['deleted'], 3)
+            res = self.client().delete('/animals?q=Batch', headers=manager)
+            self.assertEqual(json.loads(res.data)['deleted'], 1)
+        finally:
+            with self.app.app_context():
+                Animal.query.filter(Animal.comment == 'batch').delete()
+                db.session.commit()
+                animal_counter.reset()
+
+    # Test batch patch and delete requests error
+    def test_patch_and_delete_animals_batch_error(self):
+        manager = {'Authorization': farm_manager_header}
+        # without the rate limits of the batch routes
+        client = create_app({'RATE_LIMITS': {
+            'patch_animals_batch': (0, 0),
+            'delete_animals_batch': (0, 0)}}).test_client()
+        # without ids or filters
+        res = client.patch('/animals', json={'age': 1}, headers=manager)
+        self.assertEqual(res.status_code, 422)
+        res = client.delete('/animals', headers=manager)
+        self.assertEqual(res.status_code, 422)
+        # empty filters select every animal, they don't count
+        with self.app.app_context():
+            ages = [animal.age for animal in Animal.query.order_by(Animal.id)]
+        res = client.delete('/animals?q=', json={}, headers=manager)
+        self.assertEqual(res.status_code, 422)
+        res = client.patch('/animals?q=', json={'age': 7}, headers=manager)
+        self.assertEqual(res.status_code, 422)
+        with self.app.app_context():
+            self.assertEqual([animal.age for animal in
+                              Animal.query.order_by(Animal.id)], ages)
+
+        res = client.patch('/animals', json={
+            'ids': ['one'], 'age': 1}, headers=manager)
+        self.assertEqual(res.status_code, 422)
+        # values that don't fit into the integer columns and bools
+        for body in ({'ids': [1], 'age': 10 ** 20},
+                     {'ids': [10 ** 20], 'age': 1},
+                     {'ids': [True], 'age': 1},
+                     {'ids': [1], 'age': True},
+                     {'ids': [1], 'age_increment': 10 ** 20}):
+            res = client.patch('/animals', json=body, headers=manager)
+            self.assertEqual(res.status_code, 422)
+        res = client.delete('/animals', json={'ids': [10 ** 20]},
+                            headers=manager)
+        self.assertEqual(res.status_code, 422)
+        res = client.patch('/animals?species_id=1', json={
+            'age': 1, 'age_increment': 1}, headers=manager)
+        data = json.loads(res.data)
+
+        # Check for success of the test
+        self.assertEqual(res.status_code, 422)
+        self.assertFalse(data['success'])
+
     # Test patch request for animals
     def test_patch_animal(self):
         json_age = {
@@ -200,6 +1252,106 @@ class FarmTestCase(unittest.TestCase):
         self.assertFalse(data['success'])
 
 
+class JWKSCacheTestCase(unittest.TestCase):
+    # This class tests the JWKS key store with a local stand-in file
+
+    def setUp(self):
+        self.jwks_file = tempfile.NamedTemporaryFile('w', suffix='.json',
+                                                     delete=False)
+        self.write_keys(['key1'])
+
+    def tearDown(self):
+        os.remove(self.jwks_file.name)
+
+    def write_keys(self, kids):
+        with open(self.jwks_file.name, 'w') as f:
+            json.dump({'keys': [{'kid': kid} for kid in kids]}, f)
+
+    # Test that the keys are only fetched once within the ttl
+    def test_jwks_cached(self):
+        cache = JWKSCache(self.jwks_file.name, ttl=3600)
+
+        self.assertEqual(cache.get_key('key1')['kid'], 'key1')
+        self.assertEqual(cache.get_key('key1')['kid'], 'key1')
+        self.assertEqual(cache.fetch_count, 1)
+
+    # Test that an unknown kid triggers a refetch
+    def test_jwks_refetch_unknown_kid(self):
+        cache = JWKSCache(self.jwks_file.name, ttl=3600,
+                          min_refresh_interval=0)
+        cache.get_key('key1')
+        self.write_keys(['key1', 'key2'])
+
+        self.assertEqual(cache.get_key('key2')['kid'], 'key2')
+        self.assertEqual(cache.fetch_count, 2)
+
+    # Test that unknown kids can't force refetches within the interval
+    def test_jwks_refetch_rate_limited(self):
+        cache = JWKSCache(self.jwks_file.name, ttl=3600,
+                          min_refresh_interval=3600)
+        cache.get_key('key1')
+
+        self.assertIsNone(cache.get_key('bad1'))
+        self.assertIsNone(cache.get_key('bad2'))
+        self.assertEqual(cache.fetch_count, 1)
+
+    # Test that a down provider is tried once per interval and the old
+    # keys are served meanwhile
+    def test_jwks_refresh_failure(self):
+        cache = JWKSCache(self.jwks_file.name, ttl=0,
+                          min_refresh_interval=3600)
+        cache.get_key('key1')
+        cache.last_attempt -= 3600
+        os.remove(self.jwks_file.name)
+
+        with self.assertLogs('farm.jwks', 'WARNING') as logs:
+            for _ in range(3):
+                self.assertEqual(cache.get_key('key1')['kid'], 'key1')
+        self.assertEqual(len(logs.output), 1)
+        self.assertIn(self.jwks_file.name, logs.output[0])
+        self.assertEqual(cache.attempt_count, 2)
+        self.assertEqual(cache.fetch_count, 1)
+        self.write_keys(['key1'])
+
+    # Test that the keys are fetched with a timeout
+    def test_jwks_fetch_timeout(self):
+        cache = JWKSCache('https://example.com/jwks.json', timeout=2)
+        with mock.patch('urllib.request.urlopen') as urlopen:
+            urlopen.return_value.read.return_value = json.dumps(
+                {'keys': [{'kid': 'key1'}]})
+            self.assertEqual(cache.get_key('key1')['kid'], 'key1')
+        urlopen.assert_called_once_with('https://example.com/jwks.json',
+                                        timeout=2)
+
+
+class TokenCacheTestCase(unittest.TestCase):
+    # This class tests the cache of verified tokens
+
+    # Test hits, misses and the eviction of the least recently used token
+    def test_token_cache_lru(self):
+        cache = TokenCache(maxsize=2)
+        exp = time.time() + 60
+        cache.set('token1', {'sub': '1', 'exp': exp})
+        cache.set('token2', {'sub': '2', 'exp': exp})
+        cache.get('token1')
+        cache.set('token3', {'sub': '3', 'exp': exp})
+
+        self.assertEqual(cache.get('token1')['sub'], '1')
+        self.assertIsNone(cache.get('token2'))
+        self.assertEqual(cache.stats()['hits'], 2)
+        self.assertEqual(cache.stats()['misses'], 1)
+        self.assertEqual(cache.stats()['evictions'], 1)
+
+    # Test that tokens are not served after their exp claim
+    def test_token_cache_expiry(self):
+        cache = TokenCache()
+        cache.set('expired', {'sub': '1', 'exp': time.time() - 1})
+        cache.set('no_exp', {'sub': '2'})
+
+        self.assertIsNone(cache.get('expired'))
+        self.assertIsNone(cache.get('no_exp'))
+
+
 # Make the tests conveniently executable
 if __name__ == "__main__":
     unittest.main()